@@ -0,0 +1,63 @@
+"""
+Character Description Renderer
+Renders the prompt-ready Bass description from the master character profile.
+"""
+
+import os
+
+PROFILE_VERSION = 1
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+DESCRIPTION_PATH = os.path.join(TEMPLATES_DIR, f'bass_character_description_v{PROFILE_VERSION}.txt')
+
+def render_character_description(profile):
+    """Build detailed character description from master profile."""
+    if not profile:
+        return "Yellow fish character in SpongeBob style"
+    
+    char = profile['character']
+    colors = char['color_palette']
+    anatomy = char['anatomy']['proportions']
+    outfit = char['default_outfit']['outfit_items']
+    style = profile['render_style']
+    
+    return f"""
+CHARACTER IDENTITY: {char['name']}
+Species: {char['species']}
+Age: {char['age_category']}
+
+ANATOMY:
+- Form: {anatomy['height_type']}
+- Head: {anatomy['head_size_ratio']}
+- Torso: {anatomy['torso']}
+- Arms: {anatomy['arms']}
+- Legs: {anatomy['legs']}
+- No neck (head directly on torso)
+
+COLOR PALETTE:
+- Body: {colors['body_color']}
+- Underbelly: {colors['underbelly_color']}
+- Dorsal fin: {colors['fin_color']}
+- Arm fins: {colors['arm_color']}
+- Eyes: {colors['eye_color']}
+
+OUTFIT (Business Professional):
+- Jacket: {outfit['jacket']}
+- Shirt: {outfit['shirt']}
+- Tie: {outfit['tie']}
+- Pants: {outfit['pants']}
+- Shoes: {outfit['shoes']}
+
+FACIAL FEATURES:
+- Eyes: large oval cartoon eyes
+- Mouth: simple thin horizontal line
+- No nose, no eyebrows by default
+
+RENDER STYLE:
+- Art: {style['art']}
+- Lines: {style['lines']}
+- Color: {style['color_render']}
+- Shading: {style['shading']}
+- Aspect: {style['aspect_ratio']}
+
+CRITICAL: This character identity is LOCKED. All poses must maintain exact same character design.
+"""
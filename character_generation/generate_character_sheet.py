@@ -6,124 +6,103 @@ Creates reference poses for Bass character using the master character profile.
 import vertexai
 from vertexai.generative_models import GenerativeModel
 from google.cloud import storage
+from google.api_core import exceptions as gcp_exceptions
+from aiolimiter import AsyncLimiter
+from PIL import Image
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from character_description import DESCRIPTION_PATH, TEMPLATES_DIR, render_character_description
+import argparse
+import asyncio
+import functools
+import gzip
+import io
 import os
-import time
 import json
 
 PROJECT_ID = "manhwa-engine"
 LOCATION = "us-central1"
 BUCKET_NAME = "bass-ic-refs"
+CACHE_DIR = os.path.expanduser('~/.cache/bass')
+MAX_CONCURRENT = 5  # In-flight Gemini requests
+REQUESTS_PER_MINUTE = 20  # Gemini image model quota
+PALETTE_COLORS = 128  # Flat cel-shaded art fits comfortably in an 8-bit palette
 
 # Initialize Vertex AI
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 model = GenerativeModel("gemini-3-pro-image-preview")
 storage_client = storage.Client(project=PROJECT_ID)
+refs_bucket = storage_client.bucket(BUCKET_NAME)  # Shared across all poses
+
+# Token bucket: semaphore caps in-flight requests, limiter caps arrival rate
+limiter = AsyncLimiter(max_rate=REQUESTS_PER_MINUTE, time_period=60)
+
+# Retry transient quota/availability errors with jittered exponential backoff
+retry_transient = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((
+        gcp_exceptions.ResourceExhausted,
+        gcp_exceptions.TooManyRequests,
+        gcp_exceptions.ServiceUnavailable,
+    )),
+    reraise=True,
+)
 
 # Load master character profile
-def load_character_profile():
-    """Load the canonical Bass character profile."""
+@functools.lru_cache(maxsize=1)
+def get_character_profile():
+    """Load the canonical Bass character profile on first use.
+    
+    A local copy is kept in CACHE_DIR and reused while the GCS object's
+    generation number is unchanged.
+    """
+    local_path = os.path.join(CACHE_DIR, 'character_profile.json')
+    generation_path = local_path + '.generation'
+    
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob('templates/bass_character_profile.json')
-        if blob.exists():
-            return json.loads(blob.download_as_text())
-        else:
+        blob = refs_bucket.blob('templates/bass_character_profile.json')
+        try:
+            blob.reload()
+        except gcp_exceptions.NotFound:
             print("⚠️ Master profile not found in GCS, using local file")
-            with open('../templates/bass_character_profile.json', 'r') as f:
+            with open(os.path.join(TEMPLATES_DIR, 'bass_character_profile.json'), 'r') as f:
                 return json.load(f)
+        
+        cached_generation = None
+        if os.path.exists(local_path) and os.path.exists(generation_path):
+            with open(generation_path, 'r') as f:
+                cached_generation = f.read().strip()
+        
+        if cached_generation != str(blob.generation):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            blob.download_to_filename(local_path, if_generation_match=blob.generation)
+            with open(generation_path, 'w') as f:
+                f.write(str(blob.generation))
+        
+        with open(local_path, 'r') as f:
+            return json.load(f)
     except Exception as e:
         print(f"❌ Error loading profile: {e}")
         return None
 
-CHARACTER_PROFILE = load_character_profile()
-
 # Build character description from profile
+@functools.lru_cache(maxsize=1)
 def build_character_description():
-    """Build detailed character description from master profile."""
-    if not CHARACTER_PROFILE:
-        return "Yellow fish character in SpongeBob style"
-    
-    char = CHARACTER_PROFILE['character']
-    colors = char['color_palette']
-    anatomy = char['anatomy']['proportions']
-    outfit = char['default_outfit']['outfit_items']
-    style = CHARACTER_PROFILE['render_style']
-    
-    return f"""
-CHARACTER IDENTITY: {char['name']}
-Species: {char['species']}
-Age: {char['age_category']}
-
-ANATOMY:
-- Form: {anatomy['height_type']}
-- Head: {anatomy['head_size_ratio']}
-- Torso: {anatomy['torso']}
-- Arms: {anatomy['arms']}
-- Legs: {anatomy['legs']}
-- No neck (head directly on torso)
-
-COLOR PALETTE:
-- Body: {colors['body_color']}
-- Underbelly: {colors['underbelly_color']}
-- Dorsal fin: {colors['fin_color']}
-- Arm fins: {colors['arm_color']}
-- Eyes: {colors['eye_color']}
-
-OUTFIT (Business Professional):
-- Jacket: {outfit['jacket']}
-- Shirt: {outfit['shirt']}
-- Tie: {outfit['tie']}
-- Pants: {outfit['pants']}
-- Shoes: {outfit['shoes']}
-
-FACIAL FEATURES:
-- Eyes: large oval cartoon eyes
-- Mouth: simple thin horizontal line
-- No nose, no eyebrows by default
-
-RENDER STYLE:
-- Art: {style['art']}
-- Lines: {style['lines']}
-- Color: {style['color_render']}
-- Shading: {style['shading']}
-- Aspect: {style['aspect_ratio']}
-
-CRITICAL: This character identity is LOCKED. All poses must maintain exact same character design.
-"""
-
-BASE_CHARACTER = build_character_description()
-
-# 20 distinct poses (from pose_library.json)
-POSES = [
-    {"id": 0, "name": "neutral_standing", "description": "Front view, full body, arms relaxed at sides, calm expression."},
-    {"id": 1, "name": "smile_confident", "description": "Front mid-shot, small confident smile, arms loosely at sides."},
-    {"id": 2, "name": "big_grin_celebrate", "description": "Front full-body, arms raised in a V shape, big excited smile."},
-    {"id": 3, "name": "thinking_fist_to_mouth", "description": "Seated or standing 3/4 view, one fin closed in front of mouth, brows slightly furrowed, deep in thought."},
-    {"id": 4, "name": "worried_hand_on_head", "description": "Front mid-shot, one fin on top of head, eyes slightly wide, mouth tense."},
-    {"id": 5, "name": "stressed_rub_eyes", "description": "Side 3/4 view, one fin rubbing eyes, slouched slightly forward, tired expression."},
-    {"id": 6, "name": "angry_lean_forward", "description": "Front mid-shot, Bass leaning toward camera, brows sharply angled down, mouth open mid-rant, one fin pointing forward."},
-    {"id": 7, "name": "shock_mouth_wide", "description": "Close-up, eyes huge, mouth wide open, fins slightly lifted, strong surprise reaction."},
-    {"id": 8, "name": "sad_slumped", "description": "Front mid-shot, shoulders slumped, eyes downcast, small frown, fins hanging low."},
-    {"id": 9, "name": "desk_typing", "description": "Side 3/4 view, seated at desk, both fins on keyboard, focused neutral expression."},
-    {"id": 10, "name": "desk_looking_at_monitors", "description": "OTS from behind Bass, multiple monitors with charts, Bass sitting upright, focused."},
-    {"id": 11, "name": "phone_to_ear", "description": "Front mid-shot, one fin holding phone to side of head, listening expression."},
-    {"id": 12, "name": "looking_down_at_phone", "description": "3/4 view, Bass seated or standing, both fins holding phone in front of chest, screen glow on face, focused eyes."},
-    {"id": 13, "name": "coffee_mug", "description": "Front mid-shot, one fin holding coffee mug near mouth, slightly tired half-smile."},
-    {"id": 14, "name": "pointing_at_chart", "description": "Side 3/4 view at whiteboard or screen, one fin extended pointing, mouth mid-explanation."},
-    {"id": 15, "name": "walking_side_view", "description": "Profile full-body, one leg forward mid-step, briefcase fin-slung, neutral determined expression."},
-    {"id": 16, "name": "bed_alarm_4_30am", "description": "Side view in bed, Bass lying under blanket, head on pillow, sleepy half-open eyes looking at glowing 4:30 AM phone on nightstand."},
-    {"id": 17, "name": "headshot_neutral", "description": "Tight head-and-shoulders, straight-on, neutral professional expression."},
-    {"id": 18, "name": "thumbs_up", "description": "Front mid-shot, one fin giving a big thumbs-up gesture toward camera, friendly smile."},
-    {"id": 19, "name": "arms_open_presentation", "description": "Front full-body behind simple podium or mic, arms stretched wide, confident motivational expression."},
-]
-
-def generate_pose(pose_data):
-    """Generate a specific character pose using master profile."""
+    """Return the character description, preferring the precompiled asset.
     
-    prompt = f"""
-{BASE_CHARACTER}
+    Falls back to rendering from the master profile when the asset for
+    PROFILE_VERSION has not been compiled.
+    """
+    if os.path.exists(DESCRIPTION_PATH):
+        with open(DESCRIPTION_PATH, 'r') as f:
+            return f.read()
+    return render_character_description(get_character_profile())
 
-SPECIFIC POSE: {pose_data['description']}
+# Stable character prefix first, pose-specific text last, so every request
+# shares the same prompt prefix
+POSE_PROMPT_SUFFIX = """
+
+SPECIFIC POSE: {pose_desc}
 
 Requirements:
 - Character on simple neutral background (light gray or white)
@@ -135,11 +114,26 @@ Requirements:
 
 CRITICAL: Maintain EXACT character identity from profile. Same colors, same proportions, same outfit.
 """
-    
-    print(f"Generating pose {pose_data['id']}: {pose_data['name']}...")
-    
-    try:
-        response = model.generate_content(
+
+@functools.lru_cache(maxsize=1)
+def get_prompt_template():
+    """Return the pose prompt template; profile braces are escaped for .format()."""
+    base_character = build_character_description()
+    return base_character.replace("{", "{{").replace("}", "}}") + POSE_PROMPT_SUFFIX
+
+# 20 distinct poses, single source of truth shared with the scene parser
+def load_pose_library():
+    """Load the reference poses from the shared pose library template."""
+    with open(os.path.join(TEMPLATES_DIR, 'pose_library.json'), 'r') as f:
+        return json.load(f)['pose_library']
+
+POSES = load_pose_library()
+
+@retry_transient
+async def _generate_content(prompt):
+    """Call Gemini under the rate limiter, retrying transient errors."""
+    async with limiter:
+        return await model.generate_content_async(
             [prompt],
             generation_config={
                 "temperature": 0.3,  # Lower for consistency
@@ -147,16 +141,24 @@ CRITICAL: Maintain EXACT character identity from profile. Same colors, same prop
                 "max_output_tokens": 8192,
             }
         )
+
+async def generate_pose_async(pose_data):
+    """Generate a specific character pose using master profile."""
+    
+    prompt = get_prompt_template().format(pose_desc=pose_data['description'])
+    
+    print(f"Generating pose {pose_data['id']}: {pose_data['name']}...")
+    
+    try:
+        response = await _generate_content(prompt)
         
-        # Extract image
-        image_bytes = None
-        if response.candidates and len(response.candidates) > 0:
-            candidate = response.candidates[0]
-            if candidate.content and candidate.content.parts:
-                for part in candidate.content.parts:
-                    if hasattr(part, 'inline_data') and part.inline_data:
-                        image_bytes = part.inline_data.data
-                        break
+        # Extract first inline image across all candidates
+        image_bytes = next((
+            part.inline_data.data
+            for candidate in (response.candidates or [])
+            for part in (candidate.content.parts if candidate.content else [])
+            if getattr(part, 'inline_data', None) and part.inline_data.data
+        ), None)
         
         if not image_bytes:
             print(f"❌ No image generated for pose {pose_data['id']}")
@@ -168,74 +170,167 @@ CRITICAL: Maintain EXACT character identity from profile. Same colors, same prop
         print(f"❌ Error generating pose {pose_data['id']}: {str(e)}")
         return None
 
+def quantize_png(image_bytes):
+    """Re-encode an image as an optimized 8-bit palette PNG."""
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')  # MEDIANCUT only supports RGB input
+    img = img.quantize(colors=PALETTE_COLORS, method=Image.Quantize.MEDIANCUT)
+    buf = io.BytesIO()
+    img.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+@retry_transient
+def _upload_blob(blob, data, content_type, content_encoding=None):
+    """Upload bytes to a blob in a single request, retrying transient errors."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if content_encoding:
+        blob.content_encoding = content_encoding
+    # Known size keeps small objects on the one-shot multipart path
+    blob.upload_from_file(io.BytesIO(data), size=len(data), content_type=content_type)
+
+def pose_blob_name(pose_id):
+    """Return the GCS object name for a pose image."""
+    return f"character_sheet/pose_{pose_id:02d}.png"
+
+def pose_metadata(pose_id, pose_name):
+    """Build the manifest entry for a pose."""
+    return {
+        "pose_id": pose_id,
+        "name": pose_name,
+        "description": POSES[pose_id]['description']
+    }
+
 def upload_to_gcs(image_bytes, pose_id, pose_name):
-    """Upload generated image to Cloud Storage."""
+    """Upload generated image to Cloud Storage and return its manifest entry."""
     
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(f"character_sheet/pose_{pose_id:02d}.png")
+        blob = refs_bucket.blob(pose_blob_name(pose_id))
         
-        blob.upload_from_string(image_bytes, content_type='image/png')
-        
-        # Store metadata
-        metadata_blob = bucket.blob(f"metadata/pose_{pose_id:02d}.json")
-        metadata = {
-            "pose_id": pose_id,
-            "name": pose_name,
-            "description": POSES[pose_id]['description'],
-            "profile_version": "1.0"
-        }
-        metadata_blob.upload_from_string(
-            json.dumps(metadata, indent=2),
-            content_type='application/json'
-        )
+        _upload_blob(blob, image_bytes, 'image/png')
         
         print(f"✅ Uploaded pose {pose_id}: gs://{BUCKET_NAME}/character_sheet/pose_{pose_id:02d}.png")
-        return True
+        return pose_metadata(pose_id, pose_name)
         
     except Exception as e:
         print(f"❌ Upload error for pose {pose_id}: {str(e)}")
-        return False
+        return None
+
+def upload_manifest(poses_metadata):
+    """Store metadata for all uploaded poses in a single manifest blob."""
+    
+    try:
+        manifest_blob = refs_bucket.blob("metadata/character_sheet_manifest.json")
+        manifest = {
+            "profile_version": "1.0",
+            "poses": sorted(poses_metadata, key=lambda p: p['pose_id'])
+        }
+        # GCS serves Content-Encoding: gzip, so readers decompress transparently
+        _upload_blob(
+            manifest_blob,
+            gzip.compress(json.dumps(manifest, indent=2).encode('utf-8')),
+            'application/json',
+            content_encoding='gzip'
+        )
+        print(f"✅ Uploaded manifest: gs://{BUCKET_NAME}/metadata/character_sheet_manifest.json")
+        
+    except Exception as e:
+        print(f"❌ Manifest upload error: {str(e)}")
 
-def main():
-    """Generate all 20 character poses."""
+def parse_args():
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Generate Bass character reference poses.")
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="Regenerate poses even if their PNG already exists in GCS"
+    )
+    parser.add_argument(
+        '--poses',
+        type=lambda value: {int(pose_id) for pose_id in value.split(',')},
+        help="Comma-separated pose IDs to generate (e.g. 3,7,15)"
+    )
+    return parser.parse_args()
+
+async def main(args):
+    """Generate character poses concurrently, skipping ones already in GCS."""
+    
+    selected = [p for p in POSES if args.poses is None or p['id'] in args.poses]
     
     print("🎨 Starting character sheet generation...")
     print(f"📦 Project: {PROJECT_ID}")
     print(f"🗄️ Bucket: {BUCKET_NAME}")
-    print(f"🎭 Poses to generate: {len(POSES)}")
-    print(f"\n{BASE_CHARACTER}\n")
+    print(f"🎭 Poses to generate: {len(selected)}")
+    # Resolve the profile before fanning out so tasks never block the loop on it
+    print(f"\n{build_character_description()}\n")
+    get_prompt_template()
     
-    successful = 0
-    failed = 0
+    # One listing call instead of an exists() check per pose
+    existing = {b.name for b in refs_bucket.list_blobs(prefix="character_sheet/")}
     
-    for i, pose in enumerate(POSES):
-        print(f"\n[{i+1}/{len(POSES)}] Processing: {pose['name']}")
-        
-        # Generate image
-        image_bytes = generate_pose(pose)
+    sem = asyncio.Semaphore(MAX_CONCURRENT)
+    skipped = 0
+    
+    async def run(pose):
+        nonlocal skipped
+        if pose_blob_name(pose['id']) in existing and not args.force:
+            print(f"⏭️ Pose {pose['id']} already exists, skipping")
+            skipped += 1
+            return pose_metadata(pose['id'], pose['name'])
         
-        if image_bytes:
+        async with sem:
+            print(f"\n[{pose['id']+1}/{len(POSES)}] Processing: {pose['name']}")
+            
+            # Generate image
+            image_bytes = await generate_pose_async(pose)
+            
+            if not image_bytes:
+                return None
+            
+            # Shrink ~3 MB RGB output before it is stored and re-downloaded
+            image_bytes = await asyncio.to_thread(quantize_png, image_bytes)
+            
             # Upload to GCS
-            if upload_to_gcs(image_bytes, pose['id'], pose['name']):
-                successful += 1
-            else:
-                failed += 1
-        else:
-            failed += 1
+            return await asyncio.to_thread(upload_to_gcs, image_bytes, pose['id'], pose['name'])
+    
+    results = await asyncio.gather(*[run(pose) for pose in selected], return_exceptions=True)
+    
+    poses_metadata = []
+    failed = 0
+    for pose, result in zip(selected, results):
+        if isinstance(result, dict):
+            poses_metadata.append(result)
+            continue
         
-        # Rate limiting - wait 3 seconds between requests
-        if i < len(POSES) - 1:
-            time.sleep(3)
+        failed += 1
+        if isinstance(result, BaseException):
+            print(f"❌ Pose {pose['id']} failed: {result!r}")
+        # A failed regeneration leaves the previous PNG in place
+        if pose_blob_name(pose['id']) in existing:
+            poses_metadata.append(pose_metadata(pose['id'], pose['name']))
+    
+    generated = len(selected) - skipped - failed
+    
+    # Keep the manifest complete when only a subset was requested
+    poses_metadata += [
+        pose_metadata(p['id'], p['name'])
+        for p in POSES
+        if p not in selected and pose_blob_name(p['id']) in existing
+    ]
+    
+    if poses_metadata:
+        await asyncio.to_thread(upload_manifest, poses_metadata)
     
     print(f"\n{'='*50}")
     print(f"✅ Character sheet generation complete!")
-    print(f"   Successful: {successful}")
+    print(f"   Generated: {generated}")
+    print(f"   Skipped (existing): {skipped}")
     print(f"   Failed: {failed}")
-    print(f"   Total: {len(POSES)}")
+    print(f"   Total: {len(selected)}")
     print(f"{'='*50}\n")
     
     print(f"📁 View results at: https://console.cloud.google.com/storage/browser/{BUCKET_NAME}/character_sheet")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main(parse_args()))
@@ -4,6 +4,7 @@ set -e
 
 PROJECT_ID="manhwa-engine"
 FUNCTION_NAME="generate-audio"
+BATCH_FUNCTION_NAME="generate-audio-batch"
 REGION="us-central1"
 
 echo "🚀 Deploying Audio Generator Cloud Function..."
@@ -21,4 +22,19 @@ gcloud functions deploy ${FUNCTION_NAME} \
   --project=${PROJECT_ID} \
   --set-env-vars GCP_PROJECT=${PROJECT_ID}
 
+echo "🚀 Deploying Batch Audio Generator Cloud Function..."
+
+gcloud functions deploy ${BATCH_FUNCTION_NAME} \
+  --gen2 \
+  --runtime=python312 \
+  --region=${REGION} \
+  --source=. \
+  --entry-point=batch_generate_audio \
+  --trigger-http \
+  --allow-unauthenticated \
+  --memory=1GB \
+  --timeout=540s \
+  --project=${PROJECT_ID} \
+  --set-env-vars GCP_PROJECT=${PROJECT_ID}
+
 echo "✅ Audio Generator deployed!"
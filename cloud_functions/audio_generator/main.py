@@ -4,13 +4,70 @@ Generates narration audio using Google Cloud Text-to-Speech.
 """
 
 import functions_framework
+import asyncio
+import hashlib
+import io
 import json
+from google.api_core.exceptions import NotFound
 from google.cloud import texttospeech_v1 as texttospeech
 from google.cloud import storage
+from mutagen.mp3 import MP3
 import os
 
 PROJECT_ID = os.environ.get("GCP_PROJECT", "manhwa-engine")
+MAX_CONCURRENT_SYNTHESIS = 8  # In-flight TTS requests per batch
+
+# Reused across warm invocations
 storage_client = storage.Client(project=PROJECT_ID)
+tts_client = texttospeech.TextToSpeechClient()
+audio_bucket = storage_client.bucket('bass-ic-audio')
+
+# Voice and audio settings are identical for every scene
+# Select voice (calm, detached male voice)
+VOICE = texttospeech.VoiceSelectionParams(
+    language_code="en-US",
+    name="en-US-Neural2-J",  # Calm male voice
+    ssml_gender=texttospeech.SsmlVoiceGender.MALE
+)
+
+# Configure audio output
+AUDIO_CONFIG = texttospeech.AudioConfig(
+    audio_encoding=texttospeech.AudioEncoding.MP3,
+    speaking_rate=0.95,  # Slightly slower for clarity
+    pitch=0.0,  # Neutral pitch
+    sample_rate_hertz=48000  # High quality
+)
+
+def narration_cache_blob(narration):
+    """Return the cache blob keyed by narration text and synthesis settings."""
+    key = hashlib.sha256(
+        f"{narration}|{VOICE.name}|{AUDIO_CONFIG.speaking_rate}|"
+        f"{AUDIO_CONFIG.pitch}|{AUDIO_CONFIG.sample_rate_hertz}".encode('utf-8')
+    ).hexdigest()
+    return audio_bucket.blob(f"cache/{key}.mp3")
+
+def mp3_duration(audio_content):
+    """Return the playback length of MP3 bytes in seconds."""
+    return MP3(io.BytesIO(audio_content)).info.length
+
+def cached_duration(cache_blob):
+    """Return the duration of a cached clip, or None on a cache miss."""
+    try:
+        cache_blob.reload()  # One metadata GET doubles as the existence check
+    except NotFound:
+        return None
+    
+    duration = (cache_blob.metadata or {}).get('duration_seconds')
+    if duration is None:
+        return mp3_duration(cache_blob.download_as_bytes())
+    return float(duration)
+
+def upload_to_cache(cache_blob, audio_content):
+    """Store synthesized audio in the cache with its duration; return the duration."""
+    duration = mp3_duration(audio_content)
+    cache_blob.metadata = {'duration_seconds': f"{duration:.3f}"}
+    cache_blob.upload_from_string(audio_content, content_type='audio/mpeg')
+    return duration
 
 @functions_framework.http
 def generate_audio(request):
@@ -45,52 +102,133 @@ def generate_audio(request):
     print(f"🎙️ Generating audio for scene {scene_num}...")
     
     try:
-        # Initialize TTS client
-        client = texttospeech.TextToSpeechClient()
-        
-        # Configure synthesis input
-        synthesis_input = texttospeech.SynthesisInput(text=narration)
-        
-        # Select voice (calm, detached male voice)
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="en-US",
-            name="en-US-Neural2-J",  # Calm male voice
-            ssml_gender=texttospeech.SsmlVoiceGender.MALE
-        )
-        
-        # Configure audio output
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=0.95,  # Slightly slower for clarity
-            pitch=0.0,  # Neutral pitch
-            sample_rate_hertz=48000  # High quality
-        )
+        output_path = f"episode_{episode_number:03d}/narration_{scene_num:03d}.mp3"
+        cache_blob = narration_cache_blob(narration)
+        duration = cached_duration(cache_blob)
+        cached = duration is not None
         
-        # Generate audio
-        response = client.synthesize_speech(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config
-        )
+        if not cached:
+            # Configure synthesis input
+            synthesis_input = texttospeech.SynthesisInput(text=narration)
+            
+            # Generate audio
+            response = tts_client.synthesize_speech(
+                input=synthesis_input,
+                voice=VOICE,
+                audio_config=AUDIO_CONFIG
+            )
+            
+            duration = upload_to_cache(cache_blob, response.audio_content)
         
-        # Upload to GCS
-        audio_bucket = storage_client.bucket('bass-ic-audio')
-        output_path = f"episode_{episode_number:03d}/narration_{scene_num:03d}.mp3"
-        audio_blob = audio_bucket.blob(output_path)
-        audio_blob.upload_from_string(
-            response.audio_content,
-            content_type='audio/mpeg'
-        )
+        # Server-side copy from cache to the episode path
+        audio_bucket.copy_blob(cache_blob, audio_bucket, output_path)
         
-        print(f"✅ Audio {scene_num} complete: gs://bass-ic-audio/{output_path}")
+        print(f"✅ Audio {scene_num} complete{' (cached)' if cached else ''}: gs://bass-ic-audio/{output_path}")
         
         return {
             'status': 'success',
             'audio_url': f"gs://bass-ic-audio/{output_path}",
             'scene_number': scene_num,
-            'duration_estimate': len(narration.split()) * 0.5  # Rough estimate: ~0.5s per word
+            'cached': cached,
+            'duration_seconds': round(duration, 3)
         }, 200
         
     except Exception as e:
         print(f"❌ Error generating audio for scene {scene_num}: {str(e)}")
         return {'error': str(e), 'scene_number': scene_num}, 500
+
+async def synthesize_scenes(scenes, episode_number):
+    """Synthesize and upload narration for all scenes concurrently."""
+    
+    # gRPC aio channels are bound to the running event loop
+    async_client = texttospeech.TextToSpeechAsyncClient()
+    sem = asyncio.Semaphore(MAX_CONCURRENT_SYNTHESIS)
+    
+    async def one(scene):
+        scene_num = scene.get('scene_number', 0)
+        narration = scene.get('narration', '')
+        
+        if not narration:
+            return {'error': 'No narration text provided', 'scene_number': scene_num}
+        
+        try:
+            output_path = f"episode_{episode_number:03d}/narration_{scene_num:03d}.mp3"
+            cache_blob = narration_cache_blob(narration)
+            duration = await asyncio.to_thread(cached_duration, cache_blob)
+            cached = duration is not None
+            
+            if not cached:
+                async with sem:
+                    response = await async_client.synthesize_speech(
+                        input=texttospeech.SynthesisInput(text=narration),
+                        voice=VOICE,
+                        audio_config=AUDIO_CONFIG
+                    )
+                
+                duration = await asyncio.to_thread(upload_to_cache, cache_blob, response.audio_content)
+            
+            # Server-side copy from cache to the episode path
+            await asyncio.to_thread(audio_bucket.copy_blob, cache_blob, audio_bucket, output_path)
+            
+            print(f"✅ Audio {scene_num} complete{' (cached)' if cached else ''}: gs://bass-ic-audio/{output_path}")
+            
+            return {
+                'status': 'success',
+                'audio_url': f"gs://bass-ic-audio/{output_path}",
+                'scene_number': scene_num,
+                'cached': cached,
+                'duration_seconds': round(duration, 3)
+            }
+            
+        except Exception as e:
+            print(f"❌ Error generating audio for scene {scene_num}: {str(e)}")
+            return {'error': str(e), 'scene_number': scene_num}
+    
+    try:
+        return await asyncio.gather(*[one(scene) for scene in scenes])
+    finally:
+        # One channel per invocation; close it so warm containers don't leak them
+        await async_client.transport.close()
+
+@functions_framework.http
+def batch_generate_audio(request):
+    """
+    Generate narration audio for many scenes in one invocation.
+    
+    Expected JSON:
+    {
+      "scenes": [
+        {"narration": "The narration text", "scene_number": 1},
+        {"narration": "More narration", "scene_number": 2}
+      ],
+      "episode_number": 1
+    }
+    """
+    
+    request_json = request.get_json(silent=True)
+    
+    if not request_json:
+        return {'error': 'No JSON payload'}, 400
+    
+    scenes = request_json.get('scenes', [])
+    episode_number = request_json.get('episode_number', 1)
+    
+    if not scenes:
+        return {'error': 'No scenes provided'}, 400
+    
+    print(f"🎙️ Generating audio for {len(scenes)} scenes...")
+    
+    results = asyncio.run(synthesize_scenes(scenes, episode_number))
+    failed = sum(1 for r in results if 'error' in r)
+    
+    print(f"✅ Batch complete: {len(results) - failed} succeeded, {failed} failed")
+    
+    # Nothing synthesized is an outage, not a partial batch; fail so callers retry
+    all_failed = failed == len(results)
+    
+    return {
+        'status': 'error' if all_failed else 'success' if not failed else 'partial',
+        'results': results,
+        'total_scenes': len(results),
+        'failed': failed
+    }, 502 if all_failed else 200
@@ -17,8 +17,18 @@ gcloud functions deploy ${FUNCTION_NAME} \
   --trigger-http \
   --allow-unauthenticated \
   --memory=2Gi \
+  --cpu=2 \
+  --min-instances=1 \
   --timeout=300s \
   --project=${PROJECT_ID} \
   --set-env-vars GCP_PROJECT=${PROJECT_ID}
 
+# Gen2 functions run on Cloud Run; boost CPU while the container starts and
+# keep it allocated after responses so background uploads finish
+gcloud run services update ${FUNCTION_NAME} \
+  --region=${REGION} \
+  --project=${PROJECT_ID} \
+  --cpu-boost \
+  --no-cpu-throttling
+
 echo "✅ Image Generator deployed!"
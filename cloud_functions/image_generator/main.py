@@ -4,76 +4,81 @@ Implements deterministic, rule-based image generation with no AI inference.
 """
 
 import functions_framework
-import json
+import functools
+import base64
+import hashlib
+import logging
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part
 from google.cloud import storage
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from pydantic import BaseModel, Field, ValidationError
 import os
 
+from presets import CAMERA_FRAMING, DEFAULT_CAMERA_PRESET
+
 PROJECT_ID = os.environ.get("GCP_PROJECT", "manhwa-engine")
 LOCATION = "us-central1"
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger(__name__)
+
+def build_storage_client():
+    """Create a storage client whose HTTP session keeps a larger keep-alive pool."""
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, pool_block=False))
+    return storage.Client(project=PROJECT_ID, _http=session)
+
 model = GenerativeModel("gemini-3-pro-image-preview")
-storage_client = storage.Client(project=PROJECT_ID)
+storage_client = build_storage_client()
+ref_bucket = storage_client.bucket('bass-ic-refs')
+images_bucket = storage_client.bucket('bass-ic-images')
+upload_pool = ThreadPoolExecutor(max_workers=4)  # Background image uploads
+
+# Generation rules and profiles, keyed by name
+TEMPLATE_PATHS = {
+    'character_profile': 'templates/bass_character_profile.json',
+    'generation_rules': 'templates/generation_rules.json',
+    'detailed_poses': 'templates/detailed_poses.json',
+}
 
-# Load generation rules and profiles
 def load_resources():
-    """Load all generation resources from GCS."""
+    """Load all generation resources from GCS in parallel.
+    
+    One listing replaces per-template exists() checks; missing templates
+    load as None.
+    """
+    templates = dict.fromkeys(TEMPLATE_PATHS)
     try:
-        bucket = storage_client.bucket('bass-ic-refs')
-        
-        # Character profile
-        profile_blob = bucket.blob('templates/bass_character_profile.json')
-        character_profile = json.loads(profile_blob.download_as_text()) if profile_blob.exists() else None
-        
-        # Generation rules
-        rules_blob = bucket.blob('templates/generation_rules.json')
-        gen_rules = json.loads(rules_blob.download_as_text()) if rules_blob.exists() else None
+        blobs = {blob.name: blob for blob in ref_bucket.list_blobs(prefix='templates/')}
         
-        # Detailed poses
-        poses_blob = bucket.blob('templates/detailed_poses.json')
-        detailed_poses = json.loads(poses_blob.download_as_text()) if poses_blob.exists() else None
-        
-        return character_profile, gen_rules, detailed_poses
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                name: executor.submit(blobs[path].download_as_bytes)
+                for name, path in TEMPLATE_PATHS.items()
+                if path in blobs
+            }
+            for name, future in futures.items():
+                templates[name] = orjson.loads(future.result())
     except Exception as e:
-        print(f"⚠️ Error loading resources: {e}")
-        return None, None, None
-
-CHARACTER_PROFILE, GENERATION_RULES, DETAILED_POSES = load_resources()
-
-# Camera preset framing instructions
-CAMERA_FRAMING = {
-    "static_mid": "waist-up mid-shot, character centered, eye-level",
-    "static_close": "close-up on face and shoulders",
-    "static_wide": "full-body shot, show environment context",
-    "slow_push_in": "mid-shot framed for zoom-in animation",
-    "slow_pull_out": "slightly tighter frame for zoom-out animation",
-    "punch_in_reaction": "close framing for dramatic zoom to face",
-    "pan_left_to_right": "wider horizontal frame for left-to-right pan",
-    "pan_right_to_left": "wider horizontal frame for right-to-left pan",
-    "tilt_up": "frame from lower body to face for upward pan",
-    "tilt_down": "frame from face to hands/desk for downward pan",
-    "ots_monitor": "over-the-shoulder view from behind, show computer screens",
-    "pov_phone": "first-person view looking down at phone screen"
-}
-
-def build_strict_prompt(shot_data, ref_image_bytes):
-    """Build prompt following strict generation rules."""
-    
-    pose_id = shot_data.get('pose_id', 0)
-    camera_preset = shot_data.get('camera_preset_id', 'static_mid')
-    
-    # Check if this pose has detailed specifications
-    detailed_pose = None
-    if DETAILED_POSES:
-        for pose in DETAILED_POSES.get('detailed_poses', []):
-            if pose.get('pose_number') == pose_id:
-                detailed_pose = pose
-                break
+        logger.warning("⚠️ Error loading resources: %s", e)
     
-    # Build strict rules prompt
-    rules_text = """
+    return templates
+
+# Loaded once per container and reused across warm invocations
+_templates = load_resources()
+CHARACTER_PROFILE = _templates['character_profile']
+GENERATION_RULES = _templates['generation_rules']
+DETAILED_POSES = _templates['detailed_poses']
+
+# Invariant prompt fragments, rendered once per container
+_RULES_TEXT = """
 STRICT GENERATION RULES:
 - DETERMINISM: Must follow exact specifications, no creative interpretation
 - NO INFERENCE: Only render what is explicitly stated
@@ -81,14 +86,34 @@ STRICT GENERATION RULES:
   - body_shape, species, base_color_palette, fin_shape, face_geometry, eye_shape
 - FORBIDDEN: Never age character, change species, add realism/3D unless requested
 """
+
+_STYLE_TEXT = """
+RENDER STYLE (EXPLICIT):
+- 2D SpongeBob-style animation
+- Clean black outlines
+- Flat cel-shaded
+- Minimal shading
+- 16:9 aspect ratio, 2K resolution
+"""
+
+_OUTPUT_REQUIREMENTS_TEXT = """
+OUTPUT REQUIREMENTS:
+- Character identity from reference image is LOCKED
+- Only vary: pose (if specified), environment, camera framing
+- No creative interpretation beyond explicit instructions
+- Maintain exact character colors, proportions, and design
+"""
+
+def _render_character(character_profile):
+    """Render the image-locked character spec from the profile."""
+    if not character_profile:
+        return "Use exact character from reference image."
     
-    # Build character spec
-    if CHARACTER_PROFILE:
-        char = CHARACTER_PROFILE['character']
-        colors = char['color_palette']
-        outfit = char['default_outfit']['outfit_items']
-        
-        character_text = f"""
+    char = character_profile['character']
+    colors = char['color_palette']
+    outfit = char['default_outfit']['outfit_items']
+    
+    return f"""
 CHARACTER (IMAGE-LOCKED IDENTITY):
 Reference image shows the COMPLETE character identity.
 Name: {char['name']}
@@ -96,142 +121,236 @@ Colors: {colors['body_color']} body, {colors['fin_color']} fins
 Outfit: {outfit['jacket']}, {outfit['shirt']}, {outfit['tie']}
 CRITICAL: Use EXACT character from reference image - no modifications.
 """
-    else:
-        character_text = "Use exact character from reference image."
-    
-    # Build pose specification
-    if detailed_pose:
-        pose_text = f"""
+
+def _render_detailed_poses(detailed_poses):
+    """Pre-render pose specifications keyed by pose number."""
+    pose_texts = {}
+    for pose in (detailed_poses or {}).get('detailed_poses', []):
+        # First entry wins, matching the original linear search
+        pose_texts.setdefault(pose.get('pose_number'), f"""
 POSE SPECIFICATION (EXPLICIT):
-Camera: {detailed_pose['camera']['view']}, {detailed_pose['camera']['framing']}
-Expression: {detailed_pose['expression']}
-Body: {json.dumps(detailed_pose['pose'], indent=2)}
-"""
-    else:
-        pose_text = f"""
+Camera: {pose['camera']['view']}, {pose['camera']['framing']}
+Expression: {pose['expression']}
+Body: {orjson.dumps(pose['pose'], option=orjson.OPT_INDENT_2).decode()}
+""")
+    return pose_texts
+
+def _render_framing_pose(framing):
+    """Render the reference-pose fallback for a camera framing."""
+    return f"""
 POSE: Use exact pose from reference image.
-Camera Framing: {CAMERA_FRAMING.get(camera_preset, 'mid-shot')}
+Camera Framing: {framing}
 """
-    
+
+_CHAR_TEXT = _render_character(CHARACTER_PROFILE)
+_POSE_LOOKUP = _render_detailed_poses(DETAILED_POSES)
+_FRAMING_POSE_LOOKUP = {preset: _render_framing_pose(framing) for preset, framing in CAMERA_FRAMING.items()}
+_DEFAULT_FRAMING_POSE_TEXT = _render_framing_pose('mid-shot')
+
+def _escape(text):
+    """Escape literal percent signs before text is baked into a %-template."""
+    return text.replace("%", "%%")
+
+# Everything but the four per-shot slots is fixed once the profile is loaded
+_PROMPT_TEMPLATE = "".join([
+    "\n", _escape(_RULES_TEXT),
+    "\n\n", _escape(_CHAR_TEXT),
+    "\n\n%(pose_text)s\n\n",
     # Environment (text-only source)
-    environment_text = f"""
-ENVIRONMENT (TEXT-SPECIFIED):
-{shot_data.get('environment', 'blank underwater gradient')}
-Lighting: {shot_data.get('lighting_notes', 'flat cartoon lighting')}
-"""
+    "\nENVIRONMENT (TEXT-SPECIFIED):\n%(environment)s",
+    "\nLighting: %(lighting_notes)s\n",
+    "\n\n", _escape(_STYLE_TEXT),
+    "\n\nSCENE CONTEXT:\n%(narration)s",
+    "\n", _escape(_OUTPUT_REQUIREMENTS_TEXT),
+])
+
+def build_strict_prompt(shot_data):
+    """Build prompt following strict generation rules."""
     
-    # Style (must be explicit)
-    style_text = """
-RENDER STYLE (EXPLICIT):
-- 2D SpongeBob-style animation
-- Clean black outlines
-- Flat cel-shaded
-- Minimal shading
-- 16:9 aspect ratio, 2K resolution
-"""
+    # Detailed pose specification if available, else reference pose + framing
+    pose_text = _POSE_LOOKUP.get(shot_data.pose_id)
+    if pose_text is None:
+        pose_text = _FRAMING_POSE_LOOKUP.get(shot_data.camera_preset_id, _DEFAULT_FRAMING_POSE_TEXT)
     
-    full_prompt = f"""
-{rules_text}
+    return _PROMPT_TEMPLATE % {
+        'pose_text': pose_text,
+        'environment': shot_data.environment,
+        'lighting_notes': shot_data.lighting_notes,
+        'narration': shot_data.narration,
+    }
 
-{character_text}
+class ShotData(BaseModel):
+    """Shot fields the generator reads; other scene parser fields are ignored."""
+    scene_number: int = 0
+    pose_id: int = 0
+    camera_preset_id: str = DEFAULT_CAMERA_PRESET
+    environment: str = 'blank underwater gradient'
+    lighting_notes: str = 'flat cartoon lighting'
+    narration: str = ''
 
-{pose_text}
+class ShotRequest(BaseModel):
+    """Body of a generate-image request."""
+    shot_data: ShotData = Field(default_factory=ShotData)
+    episode_number: int = 1
 
-{environment_text}
+@functools.lru_cache(maxsize=64)
+def reference_pose_uri(pose_id):
+    """Return the gs:// URI of a reference pose, falling back to pose 0.
+    
+    Vertex fetches the image server-side, so the bytes never pass through
+    this function. Existence is checked once per pose per container,
+    since a failed sheet run can leave any pose missing.
+    """
+    blob_name = f"character_sheet/pose_{pose_id:02d}.png"
+    if not ref_bucket.blob(blob_name).exists():
+        logger.warning("⚠️ Reference pose %s not found, using default", pose_id)
+        blob_name = "character_sheet/pose_00.png"
+    return f"gs://bass-ic-refs/{blob_name}"
 
-{style_text}
+def image_cache_blob(prompt, pose_uri):
+    """Return (cache blob, pose URI) for rendering prompt against a reference pose.
+    
+    The key covers the full prompt, which embeds the shot fields and the
+    rendered character profile, plus the reference pose's current GCS
+    generation. Editing the profile or regenerating the character sheet
+    therefore invalidates old renders. A pose deleted since it was checked
+    falls back to pose 0, and the returned URI is the one to render with.
+    """
+    pose_blob = ref_bucket.get_blob(pose_uri.removeprefix("gs://bass-ic-refs/"))
+    if pose_blob is None:
+        logger.warning("⚠️ Reference pose %s missing, using default", pose_uri)
+        pose_uri = "gs://bass-ic-refs/character_sheet/pose_00.png"
+        pose_blob = ref_bucket.get_blob("character_sheet/pose_00.png")
+    key = hashlib.blake2b(orjson.dumps([
+        prompt,
+        pose_uri,
+        pose_blob.generation if pose_blob else None
+    ]), digest_size=16).hexdigest()
+    return images_bucket.blob(f"cache/{key}.png"), pose_uri
 
-SCENE CONTEXT:
-{shot_data.get('narration', '')}
+def upload_if_changed(output_blob, image_bytes):
+    """Upload image bytes unless the blob already holds exactly these bytes."""
+    md5_hash = base64.b64encode(hashlib.md5(image_bytes).digest()).decode('ascii')
+    
+    # Separate handle so the pending metadata on output_blob is not reloaded away
+    existing = output_blob.bucket.get_blob(output_blob.name)
+    if existing is not None and existing.md5_hash == md5_hash:
+        return
+    
+    output_blob.md5_hash = md5_hash  # GCS also verifies the upload against it
+    output_blob.upload_from_string(image_bytes, content_type='image/png')
 
-OUTPUT REQUIREMENTS:
-- Character identity from reference image is LOCKED
-- Only vary: pose (if specified), environment, camera framing
-- No creative interpretation beyond explicit instructions
-- Maintain exact character colors, proportions, and design
-"""
+def upload_image(output_blob, image_bytes, wait, skip_unchanged=True):
+    """Upload a generated image; unless wait is set, return before it finishes."""
+    if skip_unchanged:
+        future = upload_pool.submit(upload_if_changed, output_blob, image_bytes)
+    else:
+        future = upload_pool.submit(output_blob.upload_from_string, image_bytes, content_type='image/png')
+    
+    if wait:
+        future.result()  # Surface upload errors to the caller
+        return
     
-    return full_prompt
+    def log_failure(done):
+        if done.exception():
+            logger.error("❌ Background upload failed for %s: %s", output_blob.name, done.exception())
+    
+    future.add_done_callback(log_failure)
 
 @functions_framework.http
 def generate_image(request):
     """Generate image with strict rule adherence."""
     
-    request_json = request.get_json(silent=True)
+    # Malformed shots are rejected before any model call
+    try:
+        shot_request = ShotRequest.model_validate_json(request.get_data())
+    except ValidationError as e:
+        return {'error': str(e)}, 400
     
-    if not request_json:
-        return {'error': 'No JSON payload'}, 400
+    shot_data = shot_request.shot_data
+    episode_number = shot_request.episode_number
     
-    shot_data = request_json.get('shot_data', {})
-    episode_number = request_json.get('episode_number', 1)
+    scene_num = shot_data.scene_number
+    pose_id = shot_data.pose_id
+    camera_preset = shot_data.camera_preset_id
     
-    scene_num = shot_data.get('scene_number', 0)
-    pose_id = shot_data.get('pose_id', 0)
-    camera_preset = shot_data.get('camera_preset_id', 'static_mid')
+    logger.info("🎨 Generating scene %s (pose: %s, camera: %s)...", scene_num, pose_id, camera_preset)
     
-    print(f"🎨 Generating scene {scene_num} (pose: {pose_id}, camera: {camera_preset})...")
+    output_path = f"episode_{episode_number:03d}/scene_{scene_num:03d}.png"
     
     try:
-        # Get reference pose from GCS
-        ref_bucket = storage_client.bucket('bass-ic-refs')
-        ref_blob = ref_bucket.blob(f"character_sheet/pose_{pose_id:02d}.png")
-        
-        if not ref_blob.exists():
-            print(f"⚠️ Reference pose {pose_id} not found, using default")
-            ref_blob = ref_bucket.blob("character_sheet/pose_00.png")
-        
-        ref_image_bytes = ref_blob.download_as_bytes()
+        # Reference pose, read by Vertex directly from GCS
+        pose_uri = reference_pose_uri(pose_id)
         
         # Build strict prompt
-        prompt = build_strict_prompt(shot_data, ref_image_bytes)
+        prompt = build_strict_prompt(shot_data)
         
-        # Create image part from reference
-        image_part = Part.from_data(
-            mime_type="image/png",
-            data=ref_image_bytes
-        )
+        # Identical renders reuse an earlier image via a server-side copy
+        cache_blob, pose_uri = image_cache_blob(prompt, pose_uri)
+        if cache_blob.exists():
+            images_bucket.copy_blob(cache_blob, images_bucket, output_path)
+            logger.info("♻️ Scene %s reused cached image", scene_num)
+            return {
+                'status': 'success',
+                'image_url': f"gs://bass-ic-images/{output_path}",
+                'scene_number': scene_num,
+                'camera_preset': camera_preset,
+                'pose_id': pose_id,
+                'rules_applied': True,
+                'upload': 'complete',
+                'cached': True
+            }, 200
         
-        # Generate image with strict settings
-        response = model.generate_content(
+        image_part = Part.from_uri(uri=pose_uri, mime_type="image/png")
+        
+        # Generate image with strict settings; stream and stop at the first image part
+        responses = model.generate_content(
             [prompt, image_part],
             generation_config={
                 "temperature": 0.2,  # Very low for strict adherence
                 "top_p": 0.9,
                 "top_k": 20,
                 "max_output_tokens": 8192,
-            }
+            },
+            stream=True
         )
         
-        # Extract generated image
         image_bytes = None
-        if response.candidates and len(response.candidates) > 0:
-            candidate = response.candidates[0]
-            if candidate.content and candidate.content.parts:
-                for part in candidate.content.parts:
-                    if hasattr(part, 'inline_data') and part.inline_data:
-                        image_bytes = part.inline_data.data
-                        break
+        for chunk in responses:
+            if not chunk.candidates or not chunk.candidates[0].content:
+                continue
+            for part in chunk.candidates[0].content.parts:
+                inline_data = getattr(part, 'inline_data', None)
+                if inline_data is not None and inline_data.data:
+                    image_bytes = inline_data.data
+                    break
+            if image_bytes:
+                break
         
         if not image_bytes:
             return {'error': 'No image generated'}, 500
         
         # Upload to GCS
-        output_bucket = storage_client.bucket('bass-ic-images')
-        output_path = f"episode_{episode_number:03d}/scene_{scene_num:03d}.png"
-        output_blob = output_bucket.blob(output_path)
+        output_blob = images_bucket.blob(output_path)
         
         # Store metadata
         output_blob.metadata = {
             'pose_id': str(pose_id),
             'camera_preset': camera_preset,
-            'environment': shot_data.get('environment', ''),
+            'environment': shot_data.environment,
             'rules_version': '1.0',
             'deterministic': 'true'
         }
         
-        output_blob.upload_from_string(image_bytes, content_type='image/png')
+        # Response only needs the deterministic gs:// URL
+        wait = request.args.get('wait', '').lower() == 'true'
+        upload_image(output_blob, image_bytes, wait)
+        
+        # Cache copy is never awaited; a failed write only costs a future hit
+        cache_blob.metadata = output_blob.metadata
+        upload_image(cache_blob, image_bytes, wait=False, skip_unchanged=False)
         
-        print(f"✅ Scene {scene_num} complete (strict rules applied)")
+        logger.info("✅ Scene %s complete (strict rules applied)", scene_num)
         
         return {
             'status': 'success',
@@ -239,9 +358,11 @@ def generate_image(request):
             'scene_number': scene_num,
             'camera_preset': camera_preset,
             'pose_id': pose_id,
-            'rules_applied': True
+            'rules_applied': True,
+            'upload': 'complete' if wait else 'pending',
+            'cached': False
         }, 200
         
     except Exception as e:
-        print(f"❌ Error: {str(e)}")
+        logger.error("❌ Error: %s", e)
         return {'error': str(e), 'scene_number': scene_num}, 500
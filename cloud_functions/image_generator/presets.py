@@ -0,0 +1,23 @@
+"""
+Camera preset framing instructions for the image generator.
+"""
+
+from types import MappingProxyType
+
+# Read-only so per-request code cannot mutate the shared table
+CAMERA_FRAMING = MappingProxyType({
+    "static_mid": "waist-up mid-shot, character centered, eye-level",
+    "static_close": "close-up on face and shoulders",
+    "static_wide": "full-body shot, show environment context",
+    "slow_push_in": "mid-shot framed for zoom-in animation",
+    "slow_pull_out": "slightly tighter frame for zoom-out animation",
+    "punch_in_reaction": "close framing for dramatic zoom to face",
+    "pan_left_to_right": "wider horizontal frame for left-to-right pan",
+    "pan_right_to_left": "wider horizontal frame for right-to-left pan",
+    "tilt_up": "frame from lower body to face for upward pan",
+    "tilt_down": "frame from face to hands/desk for downward pan",
+    "ots_monitor": "over-the-shoulder view from behind, show computer screens",
+    "pov_phone": "first-person view looking down at phone screen"
+})
+
+DEFAULT_CAMERA_PRESET = "static_mid"
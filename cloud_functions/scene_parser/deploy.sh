@@ -17,8 +17,15 @@ gcloud functions deploy ${FUNCTION_NAME} \
   --trigger-http \
   --allow-unauthenticated \
   --memory=512MB \
+  --min-instances=1 \
   --timeout=300s \
   --project=${PROJECT_ID} \
   --set-env-vars GCP_PROJECT=${PROJECT_ID},GCP_REGION=${REGION}
 
+# Gen2 functions run on Cloud Run; boost CPU while the container starts
+gcloud run services update ${FUNCTION_NAME} \
+  --region=${REGION} \
+  --project=${PROJECT_ID} \
+  --cpu-boost
+
 echo "✅ Deployment complete!"
@@ -4,54 +4,87 @@ Parses scripts and intelligently assigns camera presets and character poses.
 """
 
 import functions_framework
-import json
+import asyncio
+import hashlib
+import logging
 import os
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig
+from vertexai.generative_models import FunctionDeclaration, GenerativeModel, GenerationConfig, Tool
 
 # Initialize Vertex AI
 PROJECT_ID = os.environ.get("GCP_PROJECT", "manhwa-engine")
 LOCATION = os.environ.get("GCP_REGION", "us-central1")
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger(__name__)
+
+def build_storage_client():
+    """Create a storage client whose HTTP session keeps a larger keep-alive pool."""
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, pool_block=False))
+    return storage.Client(project=PROJECT_ID, _http=session)
+
 model = GenerativeModel("gemini-3-flash-preview")
-storage_client = storage.Client(project=PROJECT_ID)
+storage_client = build_storage_client()
+scripts_bucket = storage_client.bucket('bass-ic-scripts')
+
+MAX_CONCURRENT_SHOTS = 10  # In-flight Gemini requests per script
+BATCH_SIZE = 16  # Shots classified per Gemini request
+BATCH_ATTEMPTS = 2  # Gemini requests per batch before accepting a short reply
+SHOT_GENERATION_CONFIG = GenerationConfig(temperature=0)  # Deterministic, so replies can be cached
+
+# Preset templates: name -> (path, top-level key)
+TEMPLATE_PATHS = {
+    'camera_presets': ('templates/camera_presets.json', 'camera_presets'),
+    'pose_library': ('templates/pose_library.json', 'pose_library'),
+}
 
 # Load presets
 def load_presets():
-    """Load camera and pose presets from templates."""
-    bucket = storage_client.bucket('bass-ic-scripts')
-    
-    # Load camera presets
-    camera_blob = bucket.blob('templates/camera_presets.json')
-    if camera_blob.exists():
-        camera_data = json.loads(camera_blob.download_as_text())
-        camera_presets = camera_data.get('camera_presets', [])
-    else:
-        camera_presets = []
-    
-    # Load pose library  
-    pose_blob = bucket.blob('templates/pose_library.json')
-    if pose_blob.exists():
-        pose_data = json.loads(pose_blob.download_as_text())
-        pose_library = pose_data.get('pose_library', [])
-    else:
-        pose_library = []
-    
-    return camera_presets, pose_library
+    """Load camera and pose presets from templates in parallel.
+    
+    One listing replaces per-template exists() checks; missing templates
+    load as empty lists.
+    """
+    blobs = {blob.name: blob for blob in scripts_bucket.list_blobs(prefix='templates/')}
+    presets = {name: [] for name in TEMPLATE_PATHS}
+    
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {
+            name: (executor.submit(blobs[path].download_as_bytes), key)
+            for name, (path, key) in TEMPLATE_PATHS.items()
+            if path in blobs
+        }
+        for name, (future, key) in futures.items():
+            presets[name] = orjson.loads(future.result()).get(key, [])
+    
+    return presets['camera_presets'], presets['pose_library']
 
+# Loaded once per container and reused across warm invocations
 CAMERA_PRESETS, POSE_LIBRARY = load_presets()
 
+# One line per preset and pose; the full JSON is mostly keys and indentation
+_PRESET_LINES = "\n".join(f"- {preset['id']}: {preset.get('description', '')}" for preset in CAMERA_PRESETS)
+_POSE_LINES = "\n".join(f"- {pose['id']} {pose.get('name', '')}: {pose.get('description', '')}" for pose in POSE_LIBRARY)
+
 # Enhanced style guide
 CINEMATIC_GUIDE = f"""
 You are an expert cinematographer for SpongeBob-style 2D animation.
 
 AVAILABLE CAMERA PRESETS:
-{json.dumps(CAMERA_PRESETS, indent=2)}
+{_PRESET_LINES}
 
 AVAILABLE CHARACTER POSES (Bass):
-{json.dumps(POSE_LIBRARY, indent=2)}
+{_POSE_LINES}
 
 Your job: For each scene description, select the BEST camera_preset_id and pose_id that:
 1. Matches the emotional tone
@@ -74,6 +107,188 @@ POSE SELECTION:
 - Use confident poses for success moments
 """
 
+def _choose_shot_parameters():
+    """JSON schema for one scene's choice; preset ids are an enum, not prompt text."""
+    camera_preset_id = {"type": "string", "description": "Camera preset id"}
+    preset_ids = [preset['id'] for preset in CAMERA_PRESETS]
+    if preset_ids:
+        camera_preset_id["enum"] = preset_ids
+    
+    return {
+        "type": "object",
+        "properties": {
+            "idx": {"type": "integer", "description": "The scene's idx from SCENES"},
+            "camera_preset_id": camera_preset_id,
+            "pose_id": {"type": "integer", "description": "Bass pose id, 0-19"},
+            "lighting_notes": {"type": "string", "description": "Brief lighting description"},
+            "reasoning": {"type": "string", "description": "Brief explanation"}
+        },
+        "required": ["idx", "camera_preset_id", "pose_id", "lighting_notes"]
+    }
+
+CHOOSE_SHOT_TOOL = Tool(function_declarations=[
+    FunctionDeclaration(
+        name="choose_shot",
+        description="Record the camera preset, pose and lighting chosen for one scene.",
+        parameters=_choose_shot_parameters()
+    )
+])
+
+def function_call_args(response):
+    """Return the args of every choose_shot call in a response, in order."""
+    calls = []
+    for part in response.candidates[0].content.parts:
+        function_call = part.function_call
+        if function_call.name != "choose_shot":
+            continue
+        args = dict(function_call.args)
+        # Struct numbers arrive as floats
+        for key in ('idx', 'pose_id'):
+            if isinstance(args.get(key), float):
+                args[key] = int(args[key])
+        calls.append(args)
+    return calls
+
+def _canonical_text(value):
+    """Collapse incidental whitespace so equal scenes render identical bytes."""
+    return " ".join(str(value).split())
+
+def build_batch_prompt(batch):
+    """Build one cinematography prompt covering a batch of (index, shot) pairs.
+
+    CINEMATIC_GUIDE is a fixed prefix and the scenes follow as canonical
+    JSON (sorted keys, compact), so repeated prefixes stay byte-identical
+    for Gemini's implicit cache and for the cinematography cache key.
+    """
+    scenes = [
+        {
+            'idx': i,
+            'narration': _canonical_text(shot.get('narration', '')),
+            'environment': _canonical_text(shot.get('environment', 'office')),
+            'emotion': _canonical_text(shot.get('emotion', 'NEUTRAL'))
+        }
+        for i, shot in batch
+    ]
+    
+    return f"""
+{CINEMATIC_GUIDE}
+
+SCENES:
+{orjson.dumps(scenes, option=orjson.OPT_SORT_KEYS).decode()}
+
+For EACH scene select the best camera_preset_id, pose_id and lighting_notes.
+Call choose_shot once per scene, in scene order, passing the scene's idx.
+"""
+
+PIPELINE_QUEUE_SIZE = 4  # Batches buffered between pipeline stages
+
+def cinematography_cache_blob(prompt):
+    """Return the cache blob for a batch prompt's choose_shot args."""
+    key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return scripts_bucket.blob(f"cache/cinematography/{key}.json")
+
+def read_cached_suggestions(cache_blob):
+    """Return cached choose_shot args, or None on a cache miss."""
+    try:
+        return orjson.loads(cache_blob.download_as_bytes())
+    except NotFound:
+        return None
+
+def merge_batch(suggestions, batch, result):
+    """Write one batch's choose_shot args into the per-shot suggestions list."""
+    batch_indices = [i for i, _ in batch]
+    for position, suggestion in enumerate(result):
+        # Prefer the echoed index; fall back to response order
+        idx = suggestion.get('idx')
+        if idx not in batch_indices and position < len(batch_indices):
+            idx = batch_indices[position]
+        if idx in batch_indices:
+            suggestions[idx] = suggestion
+
+async def suggest_cinematography(shots):
+    """Get AI recommendations for all shots, in shot order.
+    
+    Shots are sent BATCH_SIZE at a time so the guide's prompt tokens are
+    paid once per batch. Prompt building, model calls and merging run as
+    queue-connected stages, with MAX_CONCURRENT_SHOTS callers in flight.
+    """
+    prompts = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    responses = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    suggestions = [{} for _ in shots]
+    
+    async def builder():
+        indexed = list(enumerate(shots))
+        for start in range(0, len(indexed), BATCH_SIZE):
+            batch = indexed[start:start + BATCH_SIZE]
+            await prompts.put((batch, build_batch_prompt(batch)))
+        for _ in range(MAX_CONCURRENT_SHOTS):
+            await prompts.put(None)  # One stop marker per caller
+    
+    async def caller():
+        while (item := await prompts.get()) is not None:
+            batch, prompt = item
+            first, last = batch[0][0] + 1, batch[-1][0] + 1
+            
+            # Reruns of an unchanged script skip Gemini entirely
+            cache_blob = cinematography_cache_blob(prompt)
+            result = await asyncio.to_thread(read_cached_suggestions, cache_blob)
+            if result is not None:
+                logger.info("♻️ Shots %d-%d/%d from cache", first, last, len(shots))
+                await responses.put((batch, result))
+                continue
+            
+            logger.info("🎬 Processing shots %d-%d/%d", first, last, len(shots))
+            for attempt in range(1, BATCH_ATTEMPTS + 1):
+                # Sync call on a worker thread: the model's async client is bound to
+                # the first event loop, and each invocation runs a new one
+                response = await asyncio.to_thread(
+                    model.generate_content,
+                    prompt,
+                    generation_config=SHOT_GENERATION_CONFIG,
+                    tools=[CHOOSE_SHOT_TOOL]
+                )
+                result = function_call_args(response)
+                if len(result) >= len(batch):
+                    break
+                logger.warning(
+                    "⚠️ Shots %d-%d: %d/%d choose_shot calls (attempt %d/%d)",
+                    first, last, len(result), len(batch), attempt, BATCH_ATTEMPTS
+                )
+            
+            # No calls at all fails the parse; a short reply leaves defaults for the rest
+            if not result:
+                raise ValueError(f"No choose_shot calls for shots {first}-{last}")
+            
+            # Only complete replies are cached, so short ones are retried next run
+            if len(result) >= len(batch):
+                await asyncio.to_thread(
+                    cache_blob.upload_from_string,
+                    orjson.dumps(result),
+                    content_type='application/json'
+                )
+            await responses.put((batch, result))
+    
+    async def merger():
+        while (item := await responses.get()) is not None:
+            batch, result = item
+            merge_batch(suggestions, batch, result)
+    
+    producers = [asyncio.create_task(builder())]
+    producers += [asyncio.create_task(caller()) for _ in range(MAX_CONCURRENT_SHOTS)]
+    merge_task = asyncio.create_task(merger())
+    
+    try:
+        await asyncio.gather(*producers)
+        await responses.put(None)
+        await merge_task
+    except Exception:
+        # Any failed batch fails the parse, as with the serial loop
+        for task in producers + [merge_task]:
+            task.cancel()
+        raise
+    
+    return suggestions
+
 @functions_framework.http
 def parse_script_http(request):
     """HTTP endpoint for scene parsing with cinematography."""
@@ -91,12 +306,11 @@ def parse_script_http(request):
     
     try:
         # Download script
-        bucket = storage_client.bucket(bucket_name)
+        bucket = scripts_bucket if bucket_name == scripts_bucket.name else storage_client.bucket(bucket_name)
         blob = bucket.blob(file_name)
-        script_content = blob.download_as_text()
-        script_data = json.loads(script_content)
+        script_data = orjson.loads(blob.download_as_bytes())  # Parses UTF-8 bytes without decoding to str
         
-        print(f"📝 Parsing script: {file_name}")
+        logger.info("📝 Parsing script: %s", file_name)
         
         # Extract metadata
         episode_metadata = {
@@ -109,44 +323,9 @@ def parse_script_http(request):
         enhanced_shots = []
         shots = script_data.get('shots', [])
         
-        for i, shot in enumerate(shots):
-            print(f"🎬 Processing shot {i+1}/{len(shots)}")
-            
-            # Build prompt for Gemini
-            prompt = f"""
-{CINEMATIC_GUIDE}
-
-SCENE DESCRIPTION:
-{shot.get('narration', '')}
-
-Environment: {shot.get('environment', 'office')}
-Existing emotion: {shot.get('emotion', 'NEUTRAL')}
-
-Select the best:
-1. camera_preset_id (from available presets)
-2. pose_id (from 0-19)
-3. lighting_notes (brief description)
-
-Respond in JSON:
-{{
-  "camera_preset_id": "...",
-  "pose_id": 0,
-  "lighting_notes": "...",
-  "reasoning": "brief explanation"
-}}
-"""
-            
-            # Get AI recommendation
-            response = model.generate_content(
-                prompt,
-                generation_config=GenerationConfig(
-                    temperature=0.7,
-                    response_mime_type="application/json"
-                )
-            )
-            
-            ai_suggestion = json.loads(response.text)
-            
+        suggestions = asyncio.run(suggest_cinematography(shots))
+        
+        for shot, ai_suggestion in zip(shots, suggestions):
             # Enhance shot with AI suggestions
             enhanced_shot = {
                 **shot,
@@ -158,7 +337,7 @@ Respond in JSON:
             
             enhanced_shots.append(enhanced_shot)
         
-        print(f"✅ Parsed {len(enhanced_shots)} shots with cinematography")
+        logger.info("✅ Parsed %d shots with cinematography", len(enhanced_shots))
         
         return {
             'status': 'success',
@@ -168,5 +347,5 @@ Respond in JSON:
         }, 200
         
     except Exception as e:
-        print(f"❌ Parse error: {str(e)}")
+        logger.error("❌ Parse error: %s", e)
         return {'error': str(e)}, 500
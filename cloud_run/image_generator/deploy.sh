@@ -15,9 +15,13 @@ gcloud run deploy ${SERVICE_NAME} \
   --platform managed \
   --memory 2Gi \
   --cpu 2 \
-  --timeout 600s \
+  --timeout 1800s \
+  --min-instances 1 \
   --max-instances 10 \
-  --concurrency 4 \
+  --cpu-boost \
+  --startup-probe httpGet.path=/health,periodSeconds=2,failureThreshold=30,timeoutSeconds=1 \
+  --concurrency 16 \
+  --no-cpu-throttling \
   --allow-unauthenticated \
   --service-account bass-ic-automation@${PROJECT_ID}.iam.gserviceaccount.com \
   --set-env-vars GCP_PROJECT=${PROJECT_ID}
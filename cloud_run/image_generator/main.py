@@ -1,194 +1,388 @@
 """
 Image Generator Cloud Run Service
 Handles heavy ML image generation with Gemini 3 Pro Image.
-Uses lazy loading to avoid startup timeouts.
+Initializes in a background thread so startup never blocks on Vertex or GCS.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from pydantic import BaseModel, Field, ValidationError
+import functools
 import os
-import json
+import threading
+import base64
+import hashlib
+import orjson
 
-# Global variables for lazy initialization
-_vertex_initialized = False
+# Global variables for background initialization
+_ready = threading.Event()
+_init_lock = threading.Lock()
 _model = None
 _storage_client = None
+_ref_bucket = None
+_images_bucket = None
 _character_profile = None
 _generation_rules = None
+_prompt_template = None
 
 app = Flask(__name__)
 
+_UPLOAD_POOL = ThreadPoolExecutor(max_workers=4)  # Background image uploads
+BATCH_WORKERS = 8  # Scenes rendered at once by /generate-images-batch
+
 PROJECT_ID = os.environ.get("GCP_PROJECT", "manhwa-engine")
 LOCATION = "us-central1"
 
+def json_response(payload, status=200):
+    """Return a JSON response serialized with orjson."""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
 def initialize_services():
-    """Lazy initialize Vertex AI and other services on first request."""
-    global _vertex_initialized, _model, _storage_client, _character_profile, _generation_rules
+    """Initialize Vertex AI and load resources once; blocks callers until done."""
+    global _model, _storage_client, _ref_bucket, _images_bucket, _character_profile, _generation_rules, _prompt_template
     
-    if _vertex_initialized:
+    if _ready.is_set():
         return
     
-    print("🔄 Initializing Vertex AI and loading resources...")
+    with _init_lock:
+        if _ready.is_set():
+            return
+        
+        print("🔄 Initializing Vertex AI and loading resources...")
+        
+        import vertexai
+        from vertexai.generative_models import GenerativeModel
+        from google.cloud import storage
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+        
+        # Initialize Vertex AI
+        vertexai.init(project=PROJECT_ID, location=LOCATION)
+        _model = GenerativeModel("gemini-3-pro-image-preview")
+        
+        # Initialize storage client with a keep-alive pool sized for batch renders
+        credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        session = AuthorizedSession(credentials)
+        session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+        _storage_client = storage.Client(project=PROJECT_ID, _http=session)
+        _ref_bucket = _storage_client.bucket('bass-ic-refs')
+        _images_bucket = _storage_client.bucket('bass-ic-images')
+        
+        # Load character profile
+        try:
+            blob = _ref_bucket.blob('templates/bass_character_profile.json')
+            if blob.exists():
+                _character_profile = orjson.loads(blob.download_as_bytes())
+        except Exception as e:
+            print(f"⚠️ Could not load character profile: {e}")
+            _character_profile = None
+        
+        # Load generation rules
+        try:
+            blob = _ref_bucket.blob('templates/generation_rules.json')
+            if blob.exists():
+                _generation_rules = orjson.loads(blob.download_as_bytes())
+        except Exception as e:
+            print(f"⚠️ Could not load generation rules: {e}")
+            _generation_rules = None
+        
+        # Static prefix is rendered once so every scene prompt starts identically
+        prefix = render_prompt_prefix(_character_profile)
+        _prompt_template = prefix.replace("{", "{{").replace("}", "}}") + _PROMPT_BODY
+        
+        _ready.set()
+        print("✅ Initialization complete")
+
+@functools.lru_cache(maxsize=64)
+def reference_pose_uri(pose_id):
+    """Return the gs:// URI of a reference pose, falling back to pose 0.
     
-    import vertexai
-    from vertexai.generative_models import GenerativeModel
-    from google.cloud import storage
+    Vertex fetches the image server-side, so the bytes never pass through
+    this function. Existence is checked once per pose per container,
+    since a failed sheet run can leave any pose missing.
+    """
+    blob_name = f"character_sheet/pose_{pose_id:02d}.png"
+    if not _ref_bucket.blob(blob_name).exists():
+        print(f"⚠️ Reference pose {pose_id} not found, using default")
+        blob_name = "character_sheet/pose_00.png"
+    return f"gs://bass-ic-refs/{blob_name}"
+
+class ShotData(BaseModel):
+    """Shot fields the generator reads; other scene parser fields are ignored."""
+    scene_number: int = 0
+    pose_id: int = 0
+    camera_preset_id: str = 'static_mid'
+    environment: str = 'blank underwater gradient'
+    lighting_notes: str = 'flat cartoon lighting'
+    narration: str = ''
+
+class ShotRequest(BaseModel):
+    """Body of a generate-image request."""
+    shot_data: ShotData = Field(default_factory=ShotData)
+    episode_number: int = 1
+
+class BatchRequest(BaseModel):
+    """Body of a generate-images-batch request."""
+    shots: list[ShotData]
+    episode_number: int = 1
+
+def image_cache_blob(prompt, pose_uri):
+    """Return (cache blob, pose URI) for rendering prompt against a reference pose.
     
-    # Initialize Vertex AI
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-    _model = GenerativeModel("gemini-3-pro-image-preview")
+    The key covers the full prompt, which embeds the shot fields and the
+    rendered character profile, plus the reference pose's current GCS
+    generation. Editing the profile or regenerating the character sheet
+    therefore invalidates old renders. A pose deleted since it was checked
+    falls back to pose 0, and the returned URI is the one to render with.
+    """
+    pose_blob = _ref_bucket.get_blob(pose_uri.removeprefix("gs://bass-ic-refs/"))
+    if pose_blob is None:
+        print(f"⚠️ Reference pose {pose_uri} missing, using default")
+        pose_uri = "gs://bass-ic-refs/character_sheet/pose_00.png"
+        pose_blob = _ref_bucket.get_blob("character_sheet/pose_00.png")
+    key = hashlib.blake2b(orjson.dumps([
+        prompt,
+        pose_uri,
+        pose_blob.generation if pose_blob else None
+    ]), digest_size=16).hexdigest()
+    return _images_bucket.blob(f"cache/{key}.png"), pose_uri
+
+def upload_if_changed(output_blob, image_bytes):
+    """Upload image bytes unless the blob already holds exactly these bytes."""
+    md5_hash = base64.b64encode(hashlib.md5(image_bytes).digest()).decode('ascii')
     
-    # Initialize storage client
-    _storage_client = storage.Client(project=PROJECT_ID)
+    # Separate handle so the pending metadata on output_blob is not reloaded away
+    existing = output_blob.bucket.get_blob(output_blob.name)
+    if existing is not None and existing.md5_hash == md5_hash:
+        return
     
-    # Load character profile
-    try:
-        bucket = _storage_client.bucket('bass-ic-refs')
-        blob = bucket.blob('templates/bass_character_profile.json')
-        if blob.exists():
-            _character_profile = json.loads(blob.download_as_text())
-    except Exception as e:
-        print(f"⚠️ Could not load character profile: {e}")
-        _character_profile = None
+    output_blob.md5_hash = md5_hash  # GCS also verifies the upload against it
+    output_blob.upload_from_string(image_bytes, content_type='image/png')
+
+def upload_image(output_blob, image_bytes, wait, skip_unchanged=True):
+    """Upload a generated image; unless wait is set, return before it finishes."""
+    if skip_unchanged:
+        future = _UPLOAD_POOL.submit(upload_if_changed, output_blob, image_bytes)
+    else:
+        future = _UPLOAD_POOL.submit(output_blob.upload_from_string, image_bytes, content_type='image/png')
     
-    # Load generation rules
-    try:
-        bucket = _storage_client.bucket('bass-ic-refs')
-        blob = bucket.blob('templates/generation_rules.json')
-        if blob.exists():
-            _generation_rules = json.loads(blob.download_as_text())
-    except Exception as e:
-        print(f"⚠️ Could not load generation rules: {e}")
-        _generation_rules = None
+    if wait:
+        future.result()  # Surface upload errors to the caller
+        return
     
-    _vertex_initialized = True
-    print("✅ Initialization complete")
+    def log_failure(done):
+        if done.exception():
+            print(f"❌ Background upload failed for {output_blob.name}: {done.exception()}")
+    
+    future.add_done_callback(log_failure)
 
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check endpoint."""
-    return jsonify({'status': 'healthy'}), 200
+    """Health check endpoint; reports 503 until initialization finishes."""
+    if not _ready.is_set():
+        return json_response({'status': 'initializing'}, 503)
+    return json_response({'status': 'healthy'}, 200)
 
-@app.route('/generate-image', methods=['POST'])
-def generate_image():
-    """Generate scene image with strict rule adherence."""
-    
-    # Lazy initialize on first request
-    initialize_services()
-    
+def render_scene(shot_data, episode_number, wait):
+    """Render one shot to bass-ic-images and return its result entry."""
     from vertexai.generative_models import Part
     
-    request_json = request.get_json(silent=True)
+    scene_num = shot_data.scene_number
+    pose_id = shot_data.pose_id
+    camera_preset = shot_data.camera_preset_id
     
-    if not request_json:
-        return jsonify({'error': 'No JSON payload'}), 400
+    print(f"🎨 Generating scene {scene_num} (pose: {pose_id}, camera: {camera_preset})...")
     
-    shot_data = request_json.get('shot_data', {})
-    episode_number = request_json.get('episode_number', 1)
+    output_path = f"episode_{episode_number:03d}/scene_{scene_num:03d}.png"
     
-    scene_num = shot_data.get('scene_number', 0)
-    pose_id = shot_data.get('pose_id', 0)
-    camera_preset = shot_data.get('camera_preset_id', 'static_mid')
+    # Reference pose, read by Vertex directly from GCS
+    pose_uri = reference_pose_uri(pose_id)
     
-    print(f"🎨 Generating scene {scene_num} (pose: {pose_id}, camera: {camera_preset})...")
+    # Build prompt with strict rules
+    prompt = build_strict_prompt(shot_data, camera_preset)
     
-    try:
-        # Get reference pose from GCS
-        ref_bucket = _storage_client.bucket('bass-ic-refs')
-        ref_blob = ref_bucket.blob(f"character_sheet/pose_{pose_id:02d}.png")
-        
-        if not ref_blob.exists():
-            print(f"⚠️ Reference pose {pose_id} not found, using default")
-            ref_blob = ref_bucket.blob("character_sheet/pose_00.png")
-        
-        ref_image_bytes = ref_blob.download_as_bytes()
-        
-        # Build prompt with strict rules
-        prompt = build_strict_prompt(shot_data, camera_preset)
-        
-        # Create image part from reference
-        image_part = Part.from_data(
-            mime_type="image/png",
-            data=ref_image_bytes
-        )
-        
-        # Generate image with strict settings
-        response = _model.generate_content(
-            [prompt, image_part],
-            generation_config={
-                "temperature": 0.2,
-                "top_p": 0.9,
-                "top_k": 20,
-                "max_output_tokens": 8192,
-            }
-        )
-        
-        # Extract generated image
-        image_bytes = None
-        if response.candidates and len(response.candidates) > 0:
-            candidate = response.candidates[0]
-            if candidate.content and candidate.content.parts:
-                for part in candidate.content.parts:
-                    if hasattr(part, 'inline_data') and part.inline_data:
-                        image_bytes = part.inline_data.data
-                        break
-        
-        if not image_bytes:
-            return jsonify({'error': 'No image generated'}), 500
-        
-        # Upload to GCS
-        output_bucket = _storage_client.bucket('bass-ic-images')
-        output_path = f"episode_{episode_number:03d}/scene_{scene_num:03d}.png"
-        output_blob = output_bucket.blob(output_path)
-        
-        output_blob.metadata = {
-            'pose_id': str(pose_id),
-            'camera_preset': camera_preset,
-            'environment': shot_data.get('environment', ''),
-            'rules_version': '1.0',
-            'deterministic': 'true'
-        }
-        
-        output_blob.upload_from_string(image_bytes, content_type='image/png')
-        
-        print(f"✅ Scene {scene_num} complete")
-        
-        return jsonify({
+    # Identical renders reuse an earlier image via a server-side copy
+    cache_blob, pose_uri = image_cache_blob(prompt, pose_uri)
+    if cache_blob.exists():
+        _images_bucket.copy_blob(cache_blob, _images_bucket, output_path)
+        print(f"♻️ Scene {scene_num} reused cached image")
+        return {
             'status': 'success',
             'image_url': f"gs://bass-ic-images/{output_path}",
             'scene_number': scene_num,
             'camera_preset': camera_preset,
             'pose_id': pose_id,
-            'rules_applied': True
-        }), 200
-        
+            'rules_applied': True,
+            'upload': 'complete',
+            'cached': True
+        }
+    
+    image_part = Part.from_uri(uri=pose_uri, mime_type="image/png")
+    
+    # Generate image with strict settings; stream and stop at the first image part
+    responses = _model.generate_content(
+        [prompt, image_part],
+        generation_config={
+            "temperature": 0.2,
+            "top_p": 0.9,
+            "top_k": 20,
+            "max_output_tokens": 8192,
+        },
+        stream=True
+    )
+    
+    image_bytes = None
+    for chunk in responses:
+        if not chunk.candidates or not chunk.candidates[0].content:
+            continue
+        for part in chunk.candidates[0].content.parts:
+            inline_data = getattr(part, 'inline_data', None)
+            if inline_data is not None and inline_data.data:
+                image_bytes = inline_data.data
+                break
+        if image_bytes:
+            break
+    
+    if not image_bytes:
+        raise RuntimeError('No image generated')
+    
+    # Upload to GCS
+    output_blob = _images_bucket.blob(output_path)
+    
+    output_blob.metadata = {
+        'pose_id': str(pose_id),
+        'camera_preset': camera_preset,
+        'environment': shot_data.environment,
+        'rules_version': '1.0',
+        'deterministic': 'true'
+    }
+    
+    # Response only needs the deterministic gs:// URL
+    upload_image(output_blob, image_bytes, wait)
+    
+    # Cache copy is never awaited; a failed write only costs a future hit
+    cache_blob.metadata = output_blob.metadata
+    upload_image(cache_blob, image_bytes, wait=False, skip_unchanged=False)
+    
+    print(f"✅ Scene {scene_num} complete")
+    
+    return {
+        'status': 'success',
+        'image_url': f"gs://bass-ic-images/{output_path}",
+        'scene_number': scene_num,
+        'camera_preset': camera_preset,
+        'pose_id': pose_id,
+        'rules_applied': True,
+        'upload': 'complete' if wait else 'pending',
+        'cached': False
+    }
+
+@app.route('/generate-image', methods=['POST'])
+def generate_image():
+    """Generate scene image with strict rule adherence."""
+    
+    # Waits for the background initialization if it has not finished
+    initialize_services()
+    
+    # Malformed shots are rejected before any model call
+    try:
+        shot_request = ShotRequest.model_validate_json(request.get_data())
+    except ValidationError as e:
+        return json_response({'error': str(e)}, 400)
+    
+    shot_data = shot_request.shot_data
+    wait = request.args.get('wait', '').lower() == 'true'
+    
+    try:
+        return json_response(render_scene(shot_data, shot_request.episode_number, wait))
     except Exception as e:
         print(f"❌ Error: {str(e)}")
-        return jsonify({'error': str(e), 'scene_number': scene_num}), 500
+        return json_response({'error': str(e), 'scene_number': shot_data.scene_number}, 500)
 
-def build_strict_prompt(shot_data, camera_preset):
-    """Build prompt following strict generation rules."""
+@app.route('/generate-images-batch', methods=['POST'])
+def generate_images_batch():
+    """Generate every scene of an episode in one request.
     
-    # Camera framing instructions
-    CAMERA_FRAMING = {
-        "static_mid": "waist-up mid-shot, character centered, eye-level",
-        "static_close": "close-up on face and shoulders",
-        "static_wide": "full-body shot, show environment context",
-        "slow_push_in": "mid-shot framed for zoom-in animation",
-        "slow_pull_out": "slightly tighter frame for zoom-out animation",
-        "punch_in_reaction": "close framing for dramatic zoom to face",
-        "pan_left_to_right": "wider horizontal frame for left-to-right pan",
-        "pan_right_to_left": "wider horizontal frame for right-to-left pan",
-        "tilt_up": "frame from lower body to face for upward pan",
-        "tilt_down": "frame from face to hands/desk for downward pan",
-        "ots_monitor": "over-the-shoulder view from behind, show computer screens",
-        "pov_phone": "first-person view looking down at phone screen"
-    }
+    Shots render concurrently; uploads are awaited so the images exist
+    when the response returns. Any failed shot makes the batch a 503 so
+    callers retry it, and a retry reuses the cached renders of the shots
+    that succeeded.
+    """
+    initialize_services()
     
-    framing = CAMERA_FRAMING.get(camera_preset, CAMERA_FRAMING['static_mid'])
+    try:
+        batch_request = BatchRequest.model_validate_json(request.get_data())
+    except ValidationError as e:
+        return json_response({'error': str(e)}, 400)
+    
+    def render(shot_data):
+        try:
+            return render_scene(shot_data, batch_request.episode_number, wait=True)
+        except Exception as e:
+            print(f"❌ Scene {shot_data.scene_number} error: {str(e)}")
+            return {'status': 'error', 'scene_number': shot_data.scene_number, 'error': str(e)}
+    
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        results = list(executor.map(render, batch_request.shots))
+    
+    failed = sum(1 for result in results if result['status'] != 'success')
+    print(f"✅ Batch complete: {len(results) - failed}/{len(results)} scenes")
     
-    # Build character description from profile
-    if _character_profile:
-        char = _character_profile['character']
+    return json_response({
+        'status': 'success' if not failed else 'error',
+        'episode_number': batch_request.episode_number,
+        'total_scenes': len(results),
+        'failed': failed,
+        'results': results
+    }, 503 if failed else 200)
+
+# Camera framing instructions
+CAMERA_FRAMING = MappingProxyType({
+    "static_mid": "waist-up mid-shot, character centered, eye-level",
+    "static_close": "close-up on face and shoulders",
+    "static_wide": "full-body shot, show environment context",
+    "slow_push_in": "mid-shot framed for zoom-in animation",
+    "slow_pull_out": "slightly tighter frame for zoom-out animation",
+    "punch_in_reaction": "close framing for dramatic zoom to face",
+    "pan_left_to_right": "wider horizontal frame for left-to-right pan",
+    "pan_right_to_left": "wider horizontal frame for right-to-left pan",
+    "tilt_up": "frame from lower body to face for upward pan",
+    "tilt_down": "frame from face to hands/desk for downward pan",
+    "ots_monitor": "over-the-shoulder view from behind, show computer screens",
+    "pov_phone": "first-person view looking down at phone screen"
+})
+_DEFAULT_FRAMING = CAMERA_FRAMING['static_mid']
+
+# Per-scene part of the prompt, appended to the rendered prefix at init
+_PROMPT_BODY = """POSE: Use exact pose from reference image.
+Camera Framing: {framing}
+
+ENVIRONMENT:
+{environment}
+Lighting: {lighting_notes}
+
+RENDER STYLE (EXPLICIT):
+- 2D SpongeBob-style animation
+- Clean black outlines
+- Flat cel-shaded
+- Minimal shading
+- 16:9 aspect ratio, 2K resolution
+
+SCENE CONTEXT:
+{narration}
+
+CRITICAL RULES:
+1. Character identity from reference is LOCKED
+2. No modifications to character appearance
+3. Only pose and environment vary
+"""
+
+def render_prompt_prefix(character_profile):
+    """Render the rules and character block shared by every scene prompt."""
+    if character_profile:
+        char = character_profile['character']
         colors = char['color_palette']
         outfit = char['default_outfit']['outfit_items']
         
@@ -203,7 +397,7 @@ CRITICAL: Use EXACT character from reference image - no modifications.
     else:
         character_text = "Use exact character from reference image."
     
-    prompt = f"""
+    return f"""
 STRICT GENERATION RULES:
 - DETERMINISM: Must follow exact specifications, no creative interpretation
 - NO INFERENCE: Only render what is explicitly stated
@@ -212,30 +406,19 @@ STRICT GENERATION RULES:
 
 {character_text}
 
-POSE: Use exact pose from reference image.
-Camera Framing: {framing}
-
-ENVIRONMENT:
-{shot_data.get('environment', 'blank underwater gradient')}
-Lighting: {shot_data.get('lighting_notes', 'flat cartoon lighting')}
-
-RENDER STYLE (EXPLICIT):
-- 2D SpongeBob-style animation
-- Clean black outlines
-- Flat cel-shaded
-- Minimal shading
-- 16:9 aspect ratio, 2K resolution
+"""
 
-SCENE CONTEXT:
-{shot_data.get('narration', '')}
+def build_strict_prompt(shot_data, camera_preset):
+    """Build prompt following strict generation rules."""
+    return _prompt_template.format_map({
+        'framing': CAMERA_FRAMING.get(camera_preset, _DEFAULT_FRAMING),
+        'environment': shot_data.environment,
+        'lighting_notes': shot_data.lighting_notes,
+        'narration': shot_data.narration,
+    })
 
-CRITICAL RULES:
-1. Character identity from reference is LOCKED
-2. No modifications to character appearance
-3. Only pose and environment vary
-"""
-    
-    return prompt
+# Warm up while the container starts instead of on the first request
+threading.Thread(target=initialize_services, daemon=True).start()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
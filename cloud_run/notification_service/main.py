@@ -6,6 +6,8 @@ Handles Slack notifications and serves as a centralized notifier.
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify
 
 app = Flask(__name__)
@@ -13,6 +15,15 @@ app = Flask(__name__)
 # Environment variables
 SLACK_WEBHOOK_URL = os.environ.get("SLACK_WEBHOOK_URL")
 
+# Reuse one HTTPS connection to Slack across requests. urllib3 does not
+# retry POSTs on error responses, so retries only cover connection failures.
+slack_session = requests.Session()
+slack_session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.2),
+))
+
 @app.route('/notify', methods=['POST'])
 def send_notification():
     """
@@ -70,10 +81,11 @@ def send_notification():
         })
     
     try:
-        response = requests.post(
+        response = slack_session.post(
             SLACK_WEBHOOK_URL,
             json=slack_payload,
-            headers={'Content-Type': 'application/json'}
+            headers={'Content-Type': 'application/json'},
+            timeout=10
         )
         response.raise_for_status()
         print(f"✅ Notification sent to Slack. Status: {response.status_code}")
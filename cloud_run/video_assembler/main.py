@@ -4,15 +4,143 @@ Combines 96 scene images with audio into final 8-minute video.
 """
 
 from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import subprocess
 import os
 import tempfile
 import time
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 
 app = Flask(__name__)
-storage_client = storage.Client()
+
+DOWNLOAD_WORKERS = 32  # Concurrent GCS downloads per episode
+UPLOAD_WORKERS = 8  # Concurrent parts for the final video upload
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+
+def build_storage_client():
+    """Create a storage client whose keep-alive pool covers every download thread."""
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=2 * DOWNLOAD_WORKERS))
+    return storage.Client(_http=session)
+
+storage_client = build_storage_client()
+
+# GPU encode when the container has one; same target quality either way
+NVENC_ARGS = ['-c:v', 'h264_nvenc', '-preset', 'p5', '-rc', 'vbr', '-cq', '21', '-b:v', '0', '-spatial_aq', '1']
+X264_ARGS = [
+    '-c:v', 'libx264', '-preset', 'medium', '-tune', 'stillimage', '-crf', '21',
+    '-x264-params', 'aq-mode=3:scenecut=0'  # Keyframes come from scene boundaries instead
+]
+
+@functools.lru_cache(maxsize=1)
+def video_encoder_args():
+    """Return NVENC args if a GPU encoder actually opens here, else libx264 args."""
+    probe = subprocess.run(
+        ['ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+         '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+        capture_output=True
+    )
+    if probe.returncode == 0:
+        print("🎮 Encoding with NVENC")
+        return NVENC_ARGS
+    print("🖥️ NVENC unavailable, encoding with libx264")
+    return X264_ARGS
+
+# Scenes are split into this many contiguous segments, encoded side by side
+ENCODE_SEGMENTS = int(os.environ.get("ENCODE_SEGMENTS", os.cpu_count() or 2))
+# Split the cores between concurrent encoders instead of one thread per core each
+SEGMENT_THREADS = max(1, (os.cpu_count() or 2) // ENCODE_SEGMENTS)
+
+def encode_segment(images_dir, scene_numbers, output_path, data):
+    """Encode a run of still scenes to a video-only MP4; return the ffmpeg result."""
+    duration = data['duration_per_scene']
+    fps = data['fps']
+    
+    concat_file = output_path.with_suffix('.txt')
+    with open(concat_file, 'w') as f:
+        f.writelines(
+            f"file '{images_dir}/scene_{i:03d}.png'\nduration {duration}\n"
+            for i in scene_numbers
+        )
+        # Repeat last image to avoid FFmpeg bug
+        f.write(f"file '{images_dir}/scene_{scene_numbers[-1]:03d}.png'\n")
+    
+    width, height = data['resolution'].split('x')
+    
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', str(concat_file),
+        '-vf', f'scale={width}:{height},fps={fps}',
+        *video_encoder_args(),  # CRF/CQ 21, high quality
+        '-threads', str(SEGMENT_THREADS),
+        # One GOP per still scene, with an IDR exactly where each scene starts
+        '-g', str(fps * duration),
+        '-force_key_frames', f"expr:gte(t,n_forced*{duration})",
+        '-pix_fmt', 'yuv420p',
+        # Trim the repeated last frame so segments join without drift
+        '-t', str(len(scene_numbers) * duration),
+        '-an',
+        str(output_path)
+    ]
+    return subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
+
+def download_blobs(bucket, prefix, blob_names, destination_directory):
+    """Download prefix + name for each name into destination_directory/name.
+    
+    Threads share the module's storage client; the first failure is raised.
+    """
+    transfer_manager.download_many_to_path(
+        bucket,
+        blob_names,
+        destination_directory=str(destination_directory),
+        blob_name_prefix=prefix,
+        raise_exception=True,
+        worker_type=transfer_manager.THREAD,
+        max_workers=DOWNLOAD_WORKERS
+    )
+
+def download_audio_track(bucket, prefix, total_scenes, tmpdir):
+    """Download every narration clip and encode them into one AAC track.
+    
+    This runs alongside the video encode, so the final mux can copy the audio.
+    """
+    audio_dir = tmpdir / "audio"
+    audio_dir.mkdir()
+    
+    download_blobs(
+        bucket,
+        prefix,
+        [f"narration_{i:03d}.mp3" for i in range(total_scenes)],
+        audio_dir
+    )
+    print(f"  ✓ Downloaded {total_scenes} audio clips")
+    
+    audio_list = tmpdir / "audio_list.txt"
+    with open(audio_list, 'w') as f:
+        f.writelines(f"file '{audio_dir}/narration_{i:03d}.mp3'\n" for i in range(total_scenes))
+    
+    full_audio = tmpdir / "full_audio.m4a"
+    audio_concat_cmd = [
+        'ffmpeg', '-f', 'concat', '-safe', '0',
+        '-i', str(audio_list),
+        '-vn',
+        '-c:a', 'aac',
+        '-b:a', '192k',
+        '-ar', '48000',
+        str(full_audio)
+    ]
+    subprocess.run(audio_concat_cmd, check=True, capture_output=True)
+    print("✅ Audio merged")
+    return full_audio
 
 @app.route('/assemble', methods=['POST'])
 def assemble_video():
@@ -38,6 +166,8 @@ def assemble_video():
     
     start_time = time.time()
     data = request.json
+    total_scenes = data['total_scenes']
+    images_path = data['images_path']
     
     # Create temporary working directory
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -45,77 +175,59 @@ def assemble_video():
         
         print(f"📥 Downloading assets for Episode {data['episode_number']}...")
         
-        # Download all scene images
         images_dir = tmpdir / "images"
         images_dir.mkdir()
-        
         images_bucket = storage_client.bucket(data['images_bucket'])
-        for i in range(data['total_scenes']):
-            blob_name = f"{data['images_path']}scene_{i:03d}.png"
-            blob = images_bucket.blob(blob_name)
-            local_path = images_dir / f"scene_{i:03d}.png"
-            blob.download_to_filename(str(local_path))
-            print(f"  ✓ Downloaded scene {i+1}/{data['total_scenes']}")
+        audio_bucket = storage_client.bucket(data['audio_bucket'])
+        output_video = tmpdir / data['output_filename']
         
-        # Download all audio clips
-        audio_dir = tmpdir / "audio"
-        audio_dir.mkdir()
+        # Contiguous scene segments, encoded side by side and joined without re-encoding
+        scenes = list(range(total_scenes))
+        per_segment = -(-len(scenes) // ENCODE_SEGMENTS)
+        segments = [scenes[i:i + per_segment] for i in range(0, len(scenes), per_segment)]
+        segment_paths = [tmpdir / f"part_{k:02d}.mp4" for k in range(len(segments))]
         
-        audio_bucket = storage_client.bucket(data['audio_bucket'])
-        for i in range(data['total_scenes']):
-            blob_name = f"{data['audio_path']}narration_{i:03d}.mp3"
-            blob = audio_bucket.blob(blob_name)
-            local_path = audio_dir / f"narration_{i:03d}.mp3"
-            blob.download_to_filename(str(local_path))
-        
-        print(f"✅ All assets downloaded ({data['total_scenes']} images + {data['total_scenes']} audio clips)")
-        
-        # Create FFmpeg concat file for images
-        concat_file = tmpdir / "concat.txt"
-        with open(concat_file, 'w') as f:
-            for i in range(data['total_scenes']):
-                f.write(f"file '{images_dir}/scene_{i:03d}.png'\n")
-                f.write(f"duration {data['duration_per_scene']}\n")
-            # Repeat last image to avoid FFmpeg bug
-            f.write(f"file '{images_dir}/scene_{data['total_scenes']-1:03d}.png'\n")
-        
-        # Concatenate all audio files
-        print("🎵 Merging audio tracks...")
-        audio_list = tmpdir / "audio_list.txt"
-        with open(audio_list, 'w') as f:
-            for i in range(data['total_scenes']):
-                f.write(f"file '{audio_dir}/narration_{i:03d}.mp3'\n")
-        
-        full_audio = tmpdir / "full_audio.mp3"
-        audio_concat_cmd = [
-            'ffmpeg', '-f', 'concat', '-safe', '0',
-            '-i', str(audio_list),
-            '-c', 'copy',
-            str(full_audio)
-        ]
-        subprocess.run(audio_concat_cmd, check=True, capture_output=True)
-        print("✅ Audio merged")
+        with ThreadPoolExecutor(max_workers=len(segments) + 1) as executor:
+            # The audio track is only needed for the final mux, so fetch it alongside
+            audio_future = executor.submit(
+                download_audio_track, audio_bucket, data['audio_path'], total_scenes, tmpdir
+            )
+            
+            # Download images segment by segment; each segment starts encoding as
+            # soon as its own scenes land while the next segment downloads
+            futures = []
+            for k, (segment, path) in enumerate(zip(segments, segment_paths)):
+                download_blobs(
+                    images_bucket,
+                    images_path,
+                    [f"scene_{i:03d}.png" for i in segment],
+                    images_dir
+                )
+                print(f"🎬 Encoding segment {k + 1}/{len(segments)} ({len(segment)} scenes)...")
+                futures.append(executor.submit(encode_segment, images_dir, segment, path, data))
+            
+            print(f"  ✓ Downloaded {total_scenes} scenes")
+            results = [future.result() for future in futures]
+            full_audio = audio_future.result()
         
-        # Assemble final video
-        print("🎬 Assembling final video...")
-        output_video = tmpdir / data['output_filename']
+        for result in results:
+            if result.returncode != 0:
+                print(f"❌ FFmpeg error: {result.stderr}")
+                return jsonify({'error': 'Video assembly failed', 'details': result.stderr}), 500
         
-        width, height = data['resolution'].split('x')
+        parts_list = tmpdir / "parts.txt"
+        with open(parts_list, 'w') as f:
+            for path in segment_paths:
+                f.write(f"file '{path}'\n")
         
         ffmpeg_cmd = [
             'ffmpeg',
             '-f', 'concat',
             '-safe', '0',
-            '-i', str(concat_file),
+            '-i', str(parts_list),
             '-i', str(full_audio),
-            '-vf', f'scale={width}:{height},fps={data["fps"]}',
-            '-c:v', 'libx264',
-            '-preset', 'medium',
-            '-crf', '21',  # High quality
-            '-pix_fmt', 'yuv420p',
-            '-c:a', 'aac',
-            '-b:a', '192k',
-            '-ar', '48000',
+            '-c:v', 'copy',
+            '-c:a', 'copy',  # Already AAC from download_audio_track
             '-movflags', '+faststart',  # Web optimization
             '-shortest',
             str(output_video)
@@ -133,10 +245,19 @@ def assemble_video():
         print("📤 Uploading to Cloud Storage...")
         output_bucket = storage_client.bucket(data['output_bucket'])
         output_blob = output_bucket.blob(f"final/{data['output_filename']}")
-        output_blob.upload_from_filename(str(output_video))
+        output_blob.content_type = 'video/mp4'
+        
+        # Parallel multipart upload; the part size keeps small videos to a single part
+        transfer_manager.upload_chunks_concurrently(
+            str(output_video),
+            output_blob,
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            worker_type=transfer_manager.THREAD,
+            max_workers=UPLOAD_WORKERS
+        )
         
         # Get file size
-        file_size_mb = output_blob.size / (1024 * 1024)
+        file_size_mb = output_video.stat().st_size / (1024 * 1024)
         
         processing_time = time.time() - start_time
         
@@ -0,0 +1,27 @@
+"""
+Compile Character Description
+Renders templates/bass_character_profile.json into the versioned description
+asset read by the character sheet generator. Re-run and bump PROFILE_VERSION
+whenever the profile changes.
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'character_generation'))
+
+from character_description import DESCRIPTION_PATH, TEMPLATES_DIR, render_character_description
+
+def main():
+    """Write the rendered description for the current profile version."""
+    with open(os.path.join(TEMPLATES_DIR, 'bass_character_profile.json'), 'r') as f:
+        profile = json.load(f)
+    
+    with open(DESCRIPTION_PATH, 'w') as f:
+        f.write(render_character_description(profile))
+    
+    print(f"✅ Wrote {os.path.normpath(DESCRIPTION_PATH)}")
+
+if __name__ == "__main__":
+    main()
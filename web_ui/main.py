@@ -7,7 +7,7 @@ import os
 from flask import Flask, render_template, request, jsonify
 from google.cloud import storage
 from datetime import datetime
-import json
+import orjson
 
 app = Flask(__name__)
 
@@ -15,6 +15,7 @@ app = Flask(__name__)
 PROJECT_ID = os.environ.get("GCP_PROJECT", "manhwa-engine")
 SCRIPTS_BUCKET = "bass-ic-scripts"
 storage_client = storage.Client(project=PROJECT_ID)
+scripts_bucket = storage_client.bucket(SCRIPTS_BUCKET)
 
 @app.route('/')
 def index():
@@ -36,9 +37,8 @@ def upload_files():
         # Validate JSON
         try:
             script_content = script_file.read()
-            script_data = json.loads(script_content)
-            script_file.seek(0)  # Reset file pointer
-        except json.JSONDecodeError:
+            script_data = orjson.loads(script_content)
+        except orjson.JSONDecodeError:
             return jsonify({'error': 'Invalid JSON file'}), 400
         
         # Generate unique filename
@@ -47,10 +47,10 @@ def upload_files():
         script_filename = f"{episode_title}_{timestamp}.json"
         
         # Upload script to GCS
-        bucket = storage_client.bucket(SCRIPTS_BUCKET)
-        script_blob = bucket.blob(script_filename)
-        script_blob.upload_from_file(
-            script_file,
+        script_blob = scripts_bucket.blob(script_filename)
+        # Upload the bytes already read for validation instead of re-reading the file
+        script_blob.upload_from_string(
+            script_content,
             content_type='application/json'
         )
         
@@ -65,7 +65,7 @@ def upload_files():
         if 'style' in request.files and request.files['style'].filename != '':
             style_file = request.files['style']
             style_filename = f"style_guide_{timestamp}.txt"
-            style_blob = bucket.blob(f"styles/{style_filename}")
+            style_blob = scripts_bucket.blob(f"styles/{style_filename}")
             style_blob.upload_from_file(style_file)
             response_data['style_url'] = f'gs://{SCRIPTS_BUCKET}/styles/{style_filename}'
         